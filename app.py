@@ -4,7 +4,37 @@ import time
 import shutil
 import uuid
 import re
-from flask import Flask, render_template_string, request, send_from_directory, redirect, url_for, session
+import sqlite3
+import threading
+import json
+import socket
+import hashlib
+import hmac
+import zipfile
+import atexit
+import codecs
+import gzip
+import html
+import itertools
+from collections import OrderedDict
+import ssl
+import http.client
+import urllib.request
+from urllib.parse import quote, urlsplit, urlunsplit, urljoin
+try:
+    from fontTools import subset as font_subset  # optional: enables glyph subsetting of attached fonts
+    from fontTools import ttLib as font_tables  # ...and reading font names for the automatic font pick
+except ImportError:
+    font_subset = font_tables = None
+try:
+    import charset_normalizer  # optional: better encoding guesses for subtitles that are not UTF-8
+except ImportError:
+    charset_normalizer = None
+try:
+    import brotli  # optional: br responses for clients that accept it, gzip otherwise
+except ImportError:
+    brotli = None
+from flask import Flask, render_template, request, send_from_directory, redirect, url_for, session, abort, flash, jsonify, Response, g
 
 app = Flask(__name__)
 application = app  # <--- SERVER KA BOSS
@@ -12,9 +42,19 @@ app.secret_key = "final_default_font_2025"
 
 # --- FOLDERS ---
 BASE_DIR = os.getcwd()
-DOWNLOAD_FOLDER = os.path.join(BASE_DIR, "downloads")
-UPLOAD_FOLDER = os.path.join(BASE_DIR, "uploads")
-FONT_FOLDER = os.path.join(BASE_DIR, "fonts")
+# Everything jobs read and write lives here; with worker nodes it is shared storage mounted at the same path on every node
+STORAGE_ROOT = os.environ.get("STORAGE_ROOT", BASE_DIR)
+DOWNLOAD_FOLDER = os.path.join(STORAGE_ROOT, "downloads")
+UPLOAD_FOLDER = os.path.join(STORAGE_ROOT, "uploads")
+FONT_FOLDER = os.path.join(STORAGE_ROOT, "fonts")
+CACHE_FOLDER = os.path.join(STORAGE_ROOT, "cache")
+FONT_STORE = os.path.join(FONT_FOLDER, "store")
+FONT_SUBSET_FOLDER = os.path.join(FONT_FOLDER, "subset")
+SUB_CACHE_FOLDER = os.path.join(CACHE_FOLDER, "subs")
+STAGING_FOLDER = os.path.join(UPLOAD_FOLDER, "jobs")
+INCOMING_FOLDER = os.path.join(UPLOAD_FOLDER, "incoming")
+DB_PATH = os.environ.get("MUXER_DB", os.path.join(STORAGE_ROOT, "muxer.db"))
+DB_JOURNAL_MODE = os.environ.get("DB_JOURNAL_MODE", "WAL").upper()  # WAL needs shared memory between processes: use DELETE on NFS/SMB
 
 # --- SMART FFMPEG FINDER ---
 FFMPEG_BIN = shutil.which("ffmpeg")
@@ -25,8 +65,89 @@ if not FFMPEG_BIN:
     else:
         FFMPEG_BIN = "ffmpeg"
 
-for f in [DOWNLOAD_FOLDER, UPLOAD_FOLDER, FONT_FOLDER]:
+FFPROBE_BIN = shutil.which("ffprobe")
+if not FFPROBE_BIN:
+    local_ffprobe = os.path.join(BASE_DIR, "ffprobe")
+    FFPROBE_BIN = local_ffprobe if os.path.exists(local_ffprobe) else "ffprobe"
+
+for f in [DOWNLOAD_FOLDER, UPLOAD_FOLDER, FONT_FOLDER, CACHE_FOLDER, FONT_STORE, FONT_SUBSET_FOLDER, SUB_CACHE_FOLDER, STAGING_FOLDER, INCOMING_FOLDER]:
     os.makedirs(f, exist_ok=True)
+# Job specs hold absolute paths, so the bundled default font has to live on the storage root as well
+_bundled_font = os.path.join(BASE_DIR, "fonts", "default.ttf")
+if os.path.exists(_bundled_font) and not os.path.exists(os.path.join(FONT_FOLDER, "default.ttf")):
+    _tmp = os.path.join(FONT_FOLDER, f".default-{uuid.uuid4().hex}.tmp")
+    shutil.copyfile(_bundled_font, _tmp)
+    os.replace(_tmp, os.path.join(FONT_FOLDER, "default.ttf"))
+
+# --- SCHEDULER CONFIG ---
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 2))  # ffmpeg processes across all web workers and worker nodes
+MAX_JOBS_PER_UID = int(os.environ.get("MAX_JOBS_PER_UID", 1))
+SUPERVISOR_SOCKET = os.environ.get("SUPERVISOR_SOCKET")  # set: supervisor.py runs every ffmpeg, web workers only queue
+MUXER_ROLE = os.environ.get("MUXER_ROLE", "all")  # "web": accept and serve only, worker.py processes run the jobs
+WORKER_SLOTS = int(os.environ.get("WORKER_SLOTS", MAX_CONCURRENT_JOBS))  # scheduler threads per process
+LEASE_SECONDS = int(os.environ.get("LEASE_SECONDS", 60))  # a claim nobody renews for this long is taken over by another node
+
+# --- LIVE STATUS CONFIG ---
+SSE_POLL_INTERVAL = float(os.environ.get("SSE_POLL_INTERVAL", 1))
+SSE_MAX_SECONDS = int(os.environ.get("SSE_MAX_SECONDS", 300))  # browsers reconnect on their own
+
+# --- PAGE CACHE CONFIG ---
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 1000))  # rendered home pages kept per process, one per uid
+COMPRESS_MIN_BYTES = 1024
+COMPRESSIBLE_TYPES = ("text/html", "text/css", "text/plain", "text/javascript", "application/javascript", "application/json", "image/svg+xml")
+
+# --- LIVE DOWNLOAD CONFIG ---
+LIVE_CHUNK_SIZE = 256 * 1024
+LIVE_POLL_INTERVAL = float(os.environ.get("LIVE_POLL_INTERVAL", 0.5))
+
+# --- RESULT CACHE CONFIG ---
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", 20 * 1024 ** 3))
+
+# --- UPLOAD CONFIG ---
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 64 * 1024 ** 2))
+UPLOAD_TTL = int(os.environ.get("UPLOAD_TTL", 24 * 3600))  # unfinished resumable uploads are dropped after this
+
+# --- PROBE CONFIG ---
+PROBE_TIMEOUT = float(os.environ.get("PROBE_TIMEOUT", 20))
+PROBE_TTL = int(os.environ.get("PROBE_TTL", 600))
+PROBE_ERROR_TTL = int(os.environ.get("PROBE_ERROR_TTL", 30))
+
+# --- ORIGIN TUNING CONFIG ---
+ORIGIN_MIN_SAMPLES = int(os.environ.get("ORIGIN_MIN_SAMPLES", 3))  # jobs (or probes) from a host before its learned settings are used
+ORIGIN_WEIGHT = 0.3  # share of the newest sample in a host's running averages
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")  # signs in to /admin/origins (X-Admin-Token header or its form); unset = the admin pages are off
+
+# --- PREFETCH CONFIG ---
+PREFETCH_CONNECTIONS = int(os.environ.get("PREFETCH_CONNECTIONS", 4))  # parallel requests per source; 0 or 1 = ffmpeg reads the URL itself
+PREFETCH_CHUNK = int(os.environ.get("PREFETCH_CHUNK", 8 * 1024 ** 2))
+PREFETCH_START_BYTES = int(os.environ.get("PREFETCH_START_BYTES", 32 * 1024 ** 2))  # streamable sources start muxing after this much
+PREFETCH_TIMEOUT = float(os.environ.get("PREFETCH_TIMEOUT", 30))
+PREFETCH_RETRIES = 4
+
+# --- SUBTITLE INGEST CONFIG ---
+SUB_STYLE = os.environ.get("SUB_STYLE", "")  # overrides for the style SRT/VTT cues get, e.g. "Fontname=Arial,Fontsize=56,MarginV=40"
+SUB_FALLBACK_ENCODING = os.environ.get("SUB_FALLBACK_ENCODING", "cp1252")  # for non-UTF-8 scripts when charset_normalizer is missing
+
+# --- RESUME CONFIG ---
+RESUME_MAX_RETRIES = int(os.environ.get("RESUME_MAX_RETRIES", 3))
+RESUME_BACKOFF = float(os.environ.get("RESUME_BACKOFF", 30))  # before the first retry, doubled for each further one
+RESUME_MIN_PROGRESS = 60  # media seconds a failed attempt must add before its output is kept as a part
+RESUME_MARGIN = 10  # resume this far before the last reported time: a killed mux may not have flushed its tail
+
+# --- RETENTION CONFIG ---
+RETENTION_MAX_BYTES = int(os.environ.get("RETENTION_MAX_BYTES", 100 * 1024 ** 3))  # finished outputs; 0 = no budget
+RETENTION_MAX_AGE = int(os.environ.get("RETENTION_MAX_AGE", 14 * 86400))  # since last download (or finish); 0 = keep forever
+MIN_FREE_BYTES = int(os.environ.get("MIN_FREE_BYTES", 5 * 1024 ** 3))  # new jobs must leave this much disk free
+GC_INTERVAL = int(os.environ.get("GC_INTERVAL", 300))
+GC_GRACE = 3600  # untracked files younger than this may belong to a request still in flight
+
+# --- METRICS CONFIG ---
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 10))  # route timings are buffered per process this long
+JOB_DURATION_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+JOB_THROUGHPUT_BUCKETS = (256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2)
+JOB_SPEED_BUCKETS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250)
+ROUTE_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TIMED_ROUTES = ("home", "start_mux", "download", "delete")
 
 # --- USER ID HELPER ---
 def get_uid():
@@ -49,6 +170,1747 @@ def calculate_progress(log_content):
     except: pass
     return 0
 
+def log_status(log_content):
+    # Old-style status guess from a finished/unknown log (used by the one-time import)
+    percent = calculate_progress(log_content)
+    if "Error" in log_content or "Invalid data" in log_content: return "error", percent
+    if "muxing overhead" in log_content or "LSIZE" in log_content: return "done", 100
+    return "processing", percent
+
+def parse_clock(t):
+    try:
+        p = t.split(':')
+        return int(p[0]) * 3600 + int(p[1]) * 60 + float(p[2])
+    except: return None
+
+def fmt_eta(seconds):
+    if seconds is None: return ""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}" if seconds >= 3600 else f"{seconds // 60}:{seconds % 60:02d}"
+
+class ProgressTail:
+    # Follows ffmpeg's `-progress` file from a remembered byte offset so each poll only parses new lines.
+    # Duration is read once from the head of the stderr log.
+    DURATION_RE = re.compile(rb"Duration: (\d{2}:\d{2}:\d{2}\.\d{2})")
+
+    def __init__(self, progress_path, log_path, duration=None, opening=False):
+        self.progress_path = progress_path
+        self.log_path = log_path
+        self.duration = duration
+        self.offset = 0
+        self.log_offset = 0
+        self.partial = b""
+        self.log_partial = b""
+        self.started = time.time()
+        self.out_time = 0.0
+        self.speed = None
+        self.bitrate = None
+        self.total_size = 0
+        self.ended = False
+        # Started together with its ffmpeg: the first output then dates when the source opened (to the poll interval)
+        self.opening = opening
+        self.open_seconds = None
+
+    def _read_new(self, path, offset):
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                return f.read()
+        except OSError: return b""
+
+    def _find_duration(self):
+        chunk = self._read_new(self.log_path, self.log_offset)
+        if not chunk: return
+        self.log_offset += len(chunk)
+        data = self.log_partial + chunk
+        m = self.DURATION_RE.search(data)
+        if m:
+            self.duration = parse_clock(m.group(1).decode())
+            self.log_partial = b""
+        else:
+            self.log_partial = data[-64:]
+
+    def poll(self):
+        if self.duration is None: self._find_duration()
+        chunk = self._read_new(self.progress_path, self.offset)
+        if chunk:
+            self.offset += len(chunk)
+            lines = (self.partial + chunk).split(b"\n")
+            self.partial = lines.pop()
+            for line in lines:
+                key, _, value = line.decode('utf-8', 'ignore').strip().partition("=")
+                value = value.strip()
+                if key == "out_time_us" and value.lstrip("-").isdigit(): self.out_time = max(int(value) / 1e6, 0.0)
+                elif key == "speed" and value.endswith("x"):
+                    try: self.speed = float(value[:-1])
+                    except ValueError: pass
+                elif key == "bitrate" and value.endswith("kbits/s"):
+                    try: self.bitrate = float(value[:-7])
+                    except ValueError: pass
+                elif key == "total_size" and value.isdigit(): self.total_size = int(value)
+                elif key == "progress" and value == "end": self.ended = True
+        if self.opening and self.out_time > 0:
+            self.open_seconds = time.time() - self.started
+            self.opening = False
+        return self
+
+    @property
+    def percent(self):
+        if not self.duration: return 0
+        return min(int(self.out_time / self.duration * 100), 100)
+
+    @property
+    def eta(self):
+        if not self.duration or not self.speed: return None
+        return max(self.duration - self.out_time, 0) / self.speed
+
+    @property
+    def throughput(self):
+        elapsed = time.time() - self.started
+        return self.total_size / elapsed if elapsed > 0 else 0
+
+# --- JOB REGISTRY (SQLite, WAL) ---
+_db_local = threading.local()
+
+def db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+        conn.execute("PRAGMA synchronous=NORMAL" if DB_JOURNAL_MODE == "WAL" else "PRAGMA synchronous=FULL")
+        _db_local.conn = conn
+    return conn
+
+def init_db():
+    conn = db()
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uid TEXT NOT NULL,
+            realname TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL,
+            state TEXT NOT NULL,
+            percent INTEGER NOT NULL DEFAULT 0,
+            size INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_uid ON jobs(uid, realname);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, size INTEGER NOT NULL, hits INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, last_used REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS cache_lru ON cache(last_used);
+        -- Per-user font names pointing at deduplicated blobs in fonts/store/<hash><ext>
+        CREATE TABLE IF NOT EXISTS fonts (uid TEXT NOT NULL, name TEXT NOT NULL, hash TEXT NOT NULL, ext TEXT NOT NULL, size INTEGER NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (uid, name));
+        CREATE INDEX IF NOT EXISTS fonts_hash ON fonts(hash);
+        CREATE TABLE IF NOT EXISTS batches (id TEXT PRIMARY KEY, uid TEXT NOT NULL, name TEXT NOT NULL, created_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS uploads (id TEXT PRIMARY KEY, uid TEXT NOT NULL, filename TEXT NOT NULL, size INTEGER NOT NULL, "offset" INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, updated_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS probes (url TEXT PRIMARY KEY, ok INTEGER NOT NULL, info TEXT NOT NULL, probed_at REAL NOT NULL);
+        -- What jobs and probes taught us about each source host (see ORIGIN PROFILES); pinned is a JSON object of admin overrides
+        CREATE TABLE IF NOT EXISTS origins (host TEXT PRIMARY KEY, jobs INTEGER NOT NULL DEFAULT 0, failures INTEGER NOT NULL DEFAULT 0,
+            probes INTEGER NOT NULL DEFAULT 0, open_seconds REAL, probe_seconds REAL, reconnects REAL, throughput REAL,
+            layout TEXT, layout_runs INTEGER NOT NULL DEFAULT 0, layout_changes INTEGER NOT NULL DEFAULT 0, pinned TEXT, updated_at REAL NOT NULL);
+        -- Ingested subtitles per content hash; the normalized script is cache/subs/<hash>.ass
+        CREATE TABLE IF NOT EXISTS subtitles (hash TEXT PRIMARY KEY, ok INTEGER NOT NULL, info TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL);
+        -- Counters and histogram buckets shared by all web workers; labels is the rendered Prometheus label set
+        CREATE TABLE IF NOT EXISTS metrics (name TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL, PRIMARY KEY (name, labels));
+        -- Bumped on every change to a user's jobs or fonts so watchers and the page cache can skip unchanged polls
+        CREATE TABLE IF NOT EXISTS user_state (uid TEXT PRIMARY KEY, version INTEGER NOT NULL, updated_at REAL NOT NULL);
+        CREATE TRIGGER IF NOT EXISTS jobs_bump_insert AFTER INSERT ON jobs BEGIN
+            INSERT INTO user_state (uid, version, updated_at) VALUES (NEW.uid, 1, NEW.updated_at)
+            ON CONFLICT(uid) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at;
+        END;
+        CREATE TRIGGER IF NOT EXISTS jobs_bump_update AFTER UPDATE ON jobs BEGIN
+            INSERT INTO user_state (uid, version, updated_at) VALUES (NEW.uid, 1, NEW.updated_at)
+            ON CONFLICT(uid) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at;
+        END;
+        CREATE TRIGGER IF NOT EXISTS jobs_bump_delete AFTER DELETE ON jobs BEGIN
+            INSERT INTO user_state (uid, version, updated_at) VALUES (OLD.uid, 1, (julianday('now') - 2440587.5) * 86400.0)
+            ON CONFLICT(uid) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at;
+        END;
+        CREATE TRIGGER IF NOT EXISTS fonts_bump_insert AFTER INSERT ON fonts BEGIN
+            INSERT INTO user_state (uid, version, updated_at) VALUES (NEW.uid, 1, (julianday('now') - 2440587.5) * 86400.0)
+            ON CONFLICT(uid) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at;
+        END;
+        CREATE TRIGGER IF NOT EXISTS fonts_bump_update AFTER UPDATE ON fonts BEGIN
+            INSERT INTO user_state (uid, version, updated_at) VALUES (NEW.uid, 1, (julianday('now') - 2440587.5) * 86400.0)
+            ON CONFLICT(uid) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at;
+        END;
+    """)
+    add_columns("jobs", JOB_COLUMNS)
+    add_columns("fonts", FONT_COLUMNS)
+    for sql in JOB_INDEXES: conn.execute(sql)
+    import_existing_outputs()
+    import_legacy_fonts()
+
+# Columns added after the first release; created on startup when missing
+JOB_COLUMNS = {
+    "duration": "REAL",
+    "out_time": "REAL",
+    "speed": "REAL",
+    "bitrate": "REAL",
+    "eta": "REAL",
+    "throughput": "REAL",
+    "priority": "INTEGER NOT NULL DEFAULT 0",
+    "spec": "TEXT",
+    "owner": "TEXT",
+    "started_at": "REAL",
+    "live": "INTEGER NOT NULL DEFAULT 0",
+    "cache_key": "TEXT",
+    "prepared": "INTEGER NOT NULL DEFAULT 1",  # 0 = waiting for probe, 2 = being probed
+    "batch_id": "TEXT",
+    "error": "TEXT",
+    "last_downloaded_at": "REAL",
+    "expected_size": "INTEGER",  # estimated from the probe, reserved against free disk space until the job ends
+    "pid": "INTEGER",  # ffmpeg's pid under the supervisor, so a restarted supervisor can adopt it
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "retry_at": "REAL",
+    "parts": "TEXT",  # JSON list of kept partial outputs, see RESUME
+    "parent": "TEXT",  # job whose ffmpeg also writes this output (one MKV per subtitle track); cleared when it ends
+    "lease_until": "REAL",  # the owner renews it with every progress update; past it, any node may take the job over
+    "spool_size": "INTEGER",  # bytes the prefetch spool in staging will take, reserved like expected_size
+    "spooled": "INTEGER",  # how much of the spool is on disk so far
+}
+
+FONT_COLUMNS = {
+    "names": "TEXT",  # JSON list of the family/full/PostScript names inside the file, see font_names
+}
+
+JOB_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, priority, id)",
+]
+
+def add_columns(table, columns):
+    conn = db()
+    have = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns.items():
+        if name not in have:
+            try: conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+            except sqlite3.OperationalError: pass  # another worker got there first
+
+def import_existing_outputs():
+    # One-time import of outputs created before the registry existed
+    conn = db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+            conn.execute("COMMIT")
+            return
+        for f in sorted(os.listdir(DOWNLOAD_FOLDER)):
+            if not f.endswith(".mkv") or "_" not in f: continue
+            uid = f.split("_", 1)[0]
+            path = os.path.join(DOWNLOAD_FOLDER, f)
+            status, percent = "done", 100
+            if os.path.exists(path + ".log"):
+                with open(path + ".log", 'r', encoding='utf-8', errors='ignore') as lf:
+                    status, percent = log_status(lf.read())
+                # Nobody is watching an ffmpeg started by an older process any more
+                if status == "processing": status = "error"
+            st = os.stat(path)
+            conn.execute(
+                "INSERT OR IGNORE INTO jobs (uid, realname, name, state, percent, size, created_at, updated_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (uid, f, f.replace(f"{uid}_", "").replace(".mkv", ""), status, percent, st.st_size, st.st_mtime, st.st_mtime, st.st_mtime))
+        conn.execute("INSERT INTO meta (key, value) VALUES ('imported', ?)", (str(time.time()),))
+        conn.execute("COMMIT")
+    except:
+        conn.execute("ROLLBACK")
+        raise
+
+ACTIVE_STATES = ("queued", "retrying", "processing", "cancelling")
+
+# Fresh values for every column a new (or re-used) job starts with
+JOB_DEFAULTS = dict(state="queued", percent=0, size=0, finished_at=None, started_at=None, owner=None, priority=0,
+                    duration=None, out_time=None, speed=None, bitrate=None, eta=None, throughput=None, live=0, cache_key=None,
+                    prepared=1, batch_id=None, error=None, last_downloaded_at=None, expected_size=None, pid=None,
+                    attempts=0, retry_at=None, parts=None, parent=None, lease_until=None, spool_size=None, spooled=None)
+
+def job_create(uid, realname, name, spec, **fields):
+    # Re-using a finished job's name replaces it; active jobs are refused by the caller
+    now = time.time()
+    row = dict(JOB_DEFAULTS, uid=uid, realname=realname, name=name, created_at=now, updated_at=now, spec=json.dumps(spec), **fields)
+    updates = ", ".join(f"{k} = excluded.{k}" for k in row if k not in ("uid", "realname"))
+    db().execute(f"INSERT INTO jobs ({', '.join(row)}) VALUES ({', '.join('?' * len(row))}) ON CONFLICT(realname) DO UPDATE SET {updates}",
+                 tuple(row.values()))
+
+def job_update(realname, **fields):
+    fields["updated_at"] = time.time()
+    cols = ", ".join(f"{k} = ?" for k in fields)
+    db().execute(f"UPDATE jobs SET {cols} WHERE realname = ?", (*fields.values(), realname))
+
+def group_update(realname, **fields):
+    # The job and the outputs its ffmpeg writes alongside it move through their states together
+    fields["updated_at"] = time.time()
+    cols = ", ".join(f"{k} = ?" for k in fields)
+    db().execute(f"UPDATE jobs SET {cols} WHERE realname = ? OR parent = ?", (*fields.values(), realname, realname))
+
+def job_children(realname):
+    return db().execute("SELECT * FROM jobs WHERE parent = ?", (realname,)).fetchall()
+
+def job_get(realname):
+    return db().execute("SELECT * FROM jobs WHERE realname = ?", (realname,)).fetchone()
+
+def jobs_for_uid(uid):
+    return db().execute("SELECT j.*, b.name AS batch_name FROM jobs j LEFT JOIN batches b ON b.id = j.batch_id "
+                        "WHERE j.uid = ? ORDER BY j.realname", (uid,)).fetchall()
+
+def user_version(uid):
+    row = db().execute("SELECT version FROM user_state WHERE uid = ?", (uid,)).fetchone()
+    return row["version"] if row else 0
+
+def job_delete(realname):
+    db().execute("DELETE FROM jobs WHERE realname = ?", (realname,))
+
+def queue_position(job):
+    return db().execute(
+        "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND parent IS NULL AND (priority > ? OR (priority = ? AND id < ?))",
+        (job["priority"], job["priority"], job["id"])).fetchone()[0] + 1
+
+def job_view(job):
+    return {"name": job["name"], "realname": job["realname"], "status": job["state"], "percent": job["percent"],
+            "speed": job["speed"], "eta": fmt_eta(job["eta"]), "size": job["size"],
+            "position": queue_position(job) if job["state"] == "queued" else None, "live": bool(job["live"]),
+            "batch": job["batch_id"], "batch_name": job["batch_name"] if "batch_name" in job.keys() else None, "error": job["error"]}
+
+def remove_job_files(realname):
+    base = os.path.join(DOWNLOAD_FOLDER, realname)
+    for path in (base, base + ".log", base + ".progress"):
+        try: os.remove(path)
+        except OSError: pass
+
+# --- SCHEDULER ---
+# Jobs wait in the registry as 'queued'. Worker threads in every web process (or worker.py node) claim
+# them inside a write transaction, so the global and per-uid caps hold across all of them. A claim is a
+# lease: the owner renews it with each progress update, and one that lapses is retried by whoever reaps next.
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}"
+_wakeup = threading.Event()
+_stopping = threading.Event()
+_workers = []
+_workers_lock = threading.Lock()
+
+def spec_tracks(spec):
+    # [{sub_path, language, title}]; jobs with a single unlabelled subtitle only have sub_path
+    return spec.get("tracks") or [{"sub_path": spec["sub_path"]}]
+
+def spec_fonts(spec):
+    # [{path, hash, name}]: the chosen (or default) font first, then any extra ones
+    main = [{"path": spec["font_path"], "hash": spec.get("font_hash"), "name": spec.get("font_name")}] if spec.get("font_path") else []
+    return main + spec.get("fonts", [])
+
+def build_mux_cmd(job):
+    spec = json.loads(job["spec"])
+    output_path = spec.get("output") or os.path.join(DOWNLOAD_FOLDER, job["realname"])
+    progress_path = os.path.join(DOWNLOAD_FOLDER, job["realname"] + ".progress")
+    url = spec["url"]
+    fonts = spec_fonts(spec)
+    font_arg = []
+    for k, font in enumerate(fonts):
+        stream = 's:t' if len(fonts) == 1 else f's:t:{k}'
+        font_arg.extend(['-attach', font["path"], f'-metadata:{stream}', 'mimetype=application/x-truetype-font'])
+        if font["name"]: font_arg.extend([f'-metadata:{stream}', f'filename={font["name"]}'])
+    # --- USE SMART FFMPEG PATH ---
+    # A resumed attempt keeps source timestamps (rebased to 0) so its parts line up for the join
+    seek = ['-copyts', '-start_at_zero', '-ss', f'{spec["resume_from"]:.3f}'] if spec.get("resume_from") is not None else []
+    cmd = [FFMPEG_BIN, '-y', '-nostats', '-progress', progress_path]
+    # Per-origin input flags, chosen for each attempt by prepare_job_inputs (so never part of the result cache key)
+    tuning = {k: v for k, v in (spec.get("tuning") or {}).items() if k in ORIGIN_FFMPEG_FLAGS}
+    probing = [arg for k, v in tuning.items() if k in ORIGIN_PROBE_FLAGS for arg in (f'-{k}', str(v))]
+    network = [arg for k, v in tuning.items() if k not in ORIGIN_PROBE_FLAGS for arg in (f'-{k}', str(v))]
+    if spec.get("input"):  # prefetched spool pipe/file, local HLS playlist or the concat list of resumed parts
+        cmd.extend([*spec.get("input_args", []), *probing, *seek, '-i', spec["input"]])
+    else:
+        cmd.extend(['-headers', f'Referer: {url}', '-tls_verify', '0', '-reconnect', '1', '-reconnect_streamed', '1', *network, *probing,
+                    *seek, '-i', url])
+    if seek:
+        # Only the source streams; subtitle and font are added once, by the join
+        cmd.extend(['-map', '0:V', '-map', '0:a', '-c', 'copy', '-f', 'matroska', output_path])
+        return cmd
+    tracks = spec_tracks(spec)
+    for track in tracks: cmd.extend(['-i', track["sub_path"]])
+    # One MKV with every track, or one per track ("outputs"), all muxed from this single read of the source
+    if spec.get("outputs"): outputs = [(os.path.join(DOWNLOAD_FOLDER, name), [i]) for i, name in enumerate(spec["outputs"])]
+    else: outputs = [(output_path, range(len(tracks)))]
+    default = spec.get("default_track", 0)
+    for path, picked in outputs:
+        cmd.extend(font_arg)
+        cmd.extend(['-map', '0:V', '-map', '0:a'])
+        for i in picked: cmd.extend(['-map', str(i + 1)])
+        cmd.extend(['-c', 'copy'])
+        for n, i in enumerate(picked):
+            if tracks[i].get("language"): cmd.extend([f'-metadata:s:s:{n}', f'language={tracks[i]["language"]}'])
+            if tracks[i].get("title"): cmd.extend([f'-metadata:s:s:{n}', f'title={tracks[i]["title"]}'])
+            cmd.extend([f'-disposition:s:{n}', 'default' if i == default or len(picked) == 1 else '0'])
+        if job["live"]:
+            # Never seek back to patch the header, so every byte on disk is final as soon as it is written
+            cmd.extend(['-live', '1'])
+        cmd.append(path)
+    return cmd
+
+def claim_next_job():
+    conn = db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        job = None
+        running = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'processing' AND parent IS NULL").fetchone()[0]
+        if running < MAX_CONCURRENT_JOBS:
+            now = time.time()
+            job = conn.execute(
+                "SELECT * FROM jobs j WHERE (state = 'queued' AND prepared = 1 OR state = 'retrying' AND retry_at <= ?) AND parent IS NULL AND "
+                "(SELECT COUNT(*) FROM jobs r WHERE r.uid = j.uid AND r.state = 'processing' AND r.parent IS NULL) < ? "
+                "ORDER BY priority DESC, id LIMIT 1", (now, MAX_JOBS_PER_UID)).fetchone()
+            if job:
+                conn.execute("UPDATE jobs SET state = 'processing', owner = ?, started_at = ?, updated_at = ?, lease_until = ? WHERE id = ?",
+                             (OWNER_ID, now, now, now + LEASE_SECONDS, job["id"]))
+                conn.execute("UPDATE jobs SET state = 'processing', started_at = ?, updated_at = ? WHERE parent = ?", (now, now, job["realname"]))
+                job = conn.execute("SELECT * FROM jobs WHERE id = ?", (job["id"],)).fetchone()
+        conn.execute("COMMIT")
+        return job
+    except:
+        conn.execute("ROLLBACK")
+        raise
+
+def remove_job_inputs(job):
+    remove_staged_inputs(json.loads(job["spec"] or "{}"))
+
+def finish_job(job, **fields):
+    group_update(job["realname"], finished_at=time.time(), **fields)
+    for child in job_children(job["realname"]):
+        path = os.path.join(DOWNLOAD_FOLDER, child["realname"])
+        job_update(child["realname"], parent=None, size=os.path.getsize(path) if os.path.exists(path) else 0)
+    record_job_finished(job, fields)
+    try: os.remove(os.path.join(DOWNLOAD_FOLDER, job["realname"] + ".progress"))
+    except OSError: pass
+    remove_job_inputs(job)
+
+def discard_job(job):
+    # Cancelled jobs leave nothing behind
+    if job["state"] in ACTIVE_STATES:
+        record_job_finished(job, {"state": "cancelled"})
+        for child in job_children(job["realname"]):
+            job_delete(child["realname"])
+            remove_job_files(child["realname"])
+    job_delete(job["realname"])
+    remove_job_files(job["realname"])
+    remove_job_inputs(job)
+
+def prepare_job_inputs(job):
+    # Subsets the font and waits for the prefetch -> (job with the spec ffmpeg runs, Prefetch or None),
+    # or None when the job was cancelled meanwhile
+    realname = job["realname"]
+    spec = json.loads(job["spec"])
+    if spec.get("subset"):
+        subs = [track["sub_path"] for track in spec_tracks(spec)]
+        if spec.get("font_path"): spec["font_path"] = subset_font(spec["font_path"], spec["font_hash"], subs)
+        for font in spec.get("fonts", []): font["path"] = subset_font(font["path"], font["hash"], subs)
+    parts = json.loads(job["parts"] or "[]")
+    if parts and parts[-1]["end"] is None:
+        # Every part is in: join them with the subtitle and font into the real output
+        spec.update(input=write_concat_list(spec["staging"], parts), input_args=['-f', 'concat', '-safe', '0'])
+        return dict(job, spec=json.dumps(spec)), None
+    if parts: spec.update(resume_from=parts[-1]["end"], output=resume_output(spec["staging"]))
+    spec["tuning"] = input_tuning(spec["url"])
+    prefetch = (start_prefetch(spec["url"], spec["staging"], spec["tuning"].get("start_buffer"))
+                if PREFETCH_CONNECTIONS > 1 and spec.get("staging") else None)
+    if prefetch and parts: prefetch.streamable = False  # -ss needs a seekable spool, not the pipe
+    # Reserve what the spool will still take (the real size when the source told us), or release the estimate
+    job_update(realname, spool_size=prefetch and (prefetch.total or job["spool_size"]), spooled=prefetch and prefetch.on_disk)
+    if prefetch:
+        while not prefetch.ready():
+            current = job_get(realname)
+            if current is None or current["state"] == "cancelling" or current["owner"] != OWNER_ID:
+                prefetch.stop()
+                if current and current["owner"] == OWNER_ID: discard_job(job)
+                return None
+            job_update(realname, lease_until=time.time() + LEASE_SECONDS, spooled=prefetch.on_disk)
+            prefetch.wait(2)
+        if prefetch.error:
+            app.logger.warning("prefetch of %s failed, reading the source directly: %s", realname, prefetch.error)
+            prefetch.stop()
+            prefetch = None
+            job_update(realname, spool_size=None, spooled=None)
+        else: spec["input"] = prefetch.input
+    return dict(job, spec=json.dumps(spec)), prefetch
+
+def job_stats(tail, prefetch=None):
+    stats = dict(percent=tail.percent, size=tail.total_size, duration=tail.duration, out_time=tail.out_time,
+                 speed=tail.speed, bitrate=tail.bitrate, eta=tail.eta, throughput=tail.throughput)
+    if prefetch: stats["spooled"] = prefetch.on_disk
+    return stats
+
+def complete_job(job, rc, tail, prefetch=None):
+    # rc is ffmpeg's exit code, or a message when the run failed some other way
+    output_path = os.path.join(DOWNLOAD_FOLDER, job["realname"])
+    stats = dict(job_stats(tail), size=os.path.getsize(output_path) if os.path.exists(output_path) else 0)
+    if prefetch:
+        prefetch.stop()
+        # A fetch that gave up mid-stream ends ffmpeg's input early, which looks like success
+        if rc == 0 and prefetch.error: rc = f"input ended early ({prefetch.error})"
+    record_origin_job(job, rc, tail, prefetch)
+    parts = json.loads(job["parts"] or "[]")
+    if rc == 0 and parts and parts[-1]["end"] is not None:
+        # Last piece of a resumed job: keep it and queue the join right away
+        parts.append(keep_part(job, parts, None))
+        group_update(job["realname"], state="queued", prepared=1, parts=json.dumps(parts), owner=None, pid=None, **job_stats(tail))
+        return
+    if rc == 0:
+        finish_job(job, **dict(stats, state="done", percent=100, eta=0, error=None))
+        if job["cache_key"]:
+            try: cache_store(job["cache_key"], output_path)
+            except OSError as e: app.logger.warning("could not cache %s: %s", job["realname"], e)
+    else:
+        error = f"ffmpeg exited with code {rc}" if isinstance(rc, int) else rc
+        if not schedule_retry(job, parts, tail, error): finish_job(job, **dict(stats, state="error", error=error))
+
+def run_job(job):
+    realname = job["realname"]
+    output_path = os.path.join(DOWNLOAD_FOLDER, realname)
+    prepared = prepare_job_inputs(job)
+    if not prepared: return
+    job, prefetch = prepared
+    feeding = json.loads(job["spec"]).get("input") == "pipe:0"
+    with open(output_path + ".log", "w") as log_file:
+        try: proc = subprocess.Popen(build_mux_cmd(job), stdin=subprocess.PIPE if feeding else None, stdout=log_file, stderr=subprocess.STDOUT)
+        except OSError as e:
+            log_file.write(f"Error: could not start ffmpeg: {e}\n")
+            if prefetch: prefetch.stop()
+            finish_job(job, state="error", error="Could not start ffmpeg")
+            return
+    if feeding: threading.Thread(target=prefetch.feed, args=(proc.stdin,), daemon=True).start()
+    tail = ProgressTail(output_path + ".progress", output_path + ".log", duration=job["duration"], opening=True)
+    while True:
+        try: rc = proc.wait(timeout=2)
+        except subprocess.TimeoutExpired: rc = None
+        current = job_get(realname)
+        # Cancelled, or our lease lapsed and another node took the job over
+        if current is None or current["state"] == "cancelling" or current["owner"] != OWNER_ID:
+            if prefetch: prefetch.stop()
+            proc.terminate()
+            try: proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            if current is None or current["owner"] == OWNER_ID: discard_job(job)
+            return
+        tail.poll()
+        if rc is not None: return complete_job(job, rc, tail, prefetch)
+        group_update(realname, lease_until=time.time() + LEASE_SECONDS, **job_stats(tail, prefetch))
+
+def recover_job(job, reason):
+    # Finishes the bookkeeping for a job whose owner is gone: retried (resuming where it can) or failed
+    if job["state"] == "cancelling": discard_job(job)
+    else:
+        output_path = os.path.join(DOWNLOAD_FOLDER, job["realname"])
+        tail = ProgressTail(output_path + ".progress", output_path + ".log", duration=job["duration"]).poll()
+        complete_job(job, reason, tail)
+
+def reap_orphans():
+    # Jobs claimed by a web worker on this host that has since died will never finish
+    host = socket.gethostname()
+    for job in db().execute("SELECT * FROM jobs WHERE state IN ('processing', 'cancelling') AND owner LIKE ?", (host + ":%",)).fetchall():
+        pid = int(job["owner"].rsplit(":", 1)[1])
+        try:
+            os.kill(pid, 0)
+            continue
+        except ProcessLookupError: pass
+        except PermissionError: continue
+        recover_job(job, "Interrupted: the worker running it stopped")
+    # Any node: a lease that lapsed. Taking over the owner makes sure only one reaper acts on it
+    now = time.time()
+    for job in db().execute("SELECT * FROM jobs WHERE state IN ('processing', 'cancelling') AND parent IS NULL AND lease_until < ?",
+                            (now,)).fetchall():
+        if db().execute("UPDATE jobs SET owner = ? WHERE id = ? AND owner IS ? AND lease_until < ?",
+                        (OWNER_ID, job["id"], job["owner"], now)).rowcount:
+            recover_job(job, f"Interrupted: {job['owner']} stopped renewing its lease")
+    expire_uploads()
+    # A preparer that died mid-probe leaves its job parked
+    db().execute("UPDATE jobs SET prepared = 0 WHERE state = 'queued' AND prepared = 2 AND updated_at < ?", (time.time() - 300,))
+
+def _worker_loop(index):
+    last_reap = 0
+    while not _stopping.is_set():
+        try:
+            if index == 0 and time.time() - last_reap > min(30, LEASE_SECONDS / 2):
+                reap_orphans()
+                last_reap = time.time()
+            job = claim_next_job()
+            if job:
+                run_job(job)
+                _wakeup.set()  # a slot just freed up
+                continue
+        except Exception as e:
+            app.logger.exception("scheduler worker failed: %s", e)
+        _wakeup.wait(timeout=2)
+        _wakeup.clear()
+
+def prepare_next_job():
+    # Probes queued batch items ahead of the workers so a bad source fails before it gets a slot
+    conn = db()
+    job = conn.execute("SELECT * FROM jobs WHERE state = 'queued' AND prepared = 0 ORDER BY priority DESC, id LIMIT 1").fetchone()
+    if not job: return False
+    if conn.execute("UPDATE jobs SET prepared = 2, updated_at = ? WHERE id = ? AND prepared = 0", (time.time(), job["id"])).rowcount == 0:
+        return True  # another process took it
+    probe = probe_source(json.loads(job["spec"])["url"])
+    if probe["ok"] and not has_room_for(probe):
+        # Stays queued until the sweeper (or finishing jobs) free enough disk
+        job_update(job["realname"], prepared=0)
+        return False
+    if probe["ok"]:
+        job_update(job["realname"], prepared=1, duration=probe["duration"], expected_size=estimate_output_size(probe),
+                   spool_size=estimate_spool_size(probe))
+        _wakeup.set()
+    else:
+        finish_job(job, state="error", prepared=1, error=probe["error"])
+    return True
+
+def _preparer_loop():
+    # Also runs the storage sweeper: unlike worker threads it never blocks for a whole mux
+    last_sweep = 0
+    while not _stopping.is_set():
+        try:
+            if time.time() - last_sweep > GC_INTERVAL:
+                last_sweep = time.time()
+                if claim_sweep(): sweep_storage()
+            if prepare_next_job(): continue
+        except Exception as e:
+            app.logger.exception("preparer failed: %s", e)
+        _stopping.wait(2)
+
+def ensure_scheduler():
+    if _workers or SUPERVISOR_SOCKET or MUXER_ROLE == "web": return
+    with _workers_lock:
+        if _workers: return
+        threads = [threading.Thread(target=_worker_loop, args=(i,), daemon=True) for i in range(WORKER_SLOTS)]
+        threads.append(threading.Thread(target=_preparer_loop, daemon=True))
+        for t in threads: t.start()
+        _workers.extend(threads)
+
+def stop_scheduler():
+    # Stops claiming new work; the threads exit once their current job (or probe) is done
+    _stopping.set()
+    _wakeup.set()
+    return list(_workers)
+
+def supervisor_call(op, **args):
+    # One JSON line each way over the supervisor's Unix socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(2)
+        sock.connect(SUPERVISOR_SOCKET)
+        sock.sendall((json.dumps(dict(args, op=op)) + "\n").encode())
+        reply = sock.makefile("rb").readline()
+    return json.loads(reply or b"{}")
+
+def notify_scheduler(op="wake", **args):
+    # Best effort: the registry is the queue, so a missed nudge only costs the supervisor's next poll
+    if not SUPERVISOR_SOCKET:
+        ensure_scheduler()
+        _wakeup.set()
+        return
+    try: supervisor_call(op, **args)
+    except (OSError, ValueError) as e: app.logger.warning("supervisor unreachable (%s): %s", op, e)
+
+# --- RESULT CACHE ---
+# Finished outputs are hardlinked into cache/<key>.mkv. The key covers everything that decides the
+# output bytes, so an identical request is answered with another link instead of a new fetch + mux.
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    default_port = {"http": 80, "https": 443}.get(parts.scheme.lower())
+    if parts.port and parts.port != default_port: host = f"{host}:{parts.port}"
+    return urlunsplit((parts.scheme.lower(), host, parts.path or "/", parts.query, ""))
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""): h.update(block)
+    return h.hexdigest()
+
+def result_cache_key(spec, live):
+    # Build the command with placeholder paths so only the argument set itself is hashed
+    placeholders = dict(spec, url="INPUT", sub_path="SUB", font_path="FONT" if spec.get("font_path") else None)
+    if spec.get("tracks"): placeholders["tracks"] = [dict(track, sub_path=f"SUB{i}") for i, track in enumerate(spec["tracks"])]
+    if spec.get("fonts"): placeholders["fonts"] = [dict(font, path=f"FONT{i}") for i, font in enumerate(spec["fonts"])]
+    template = {"realname": "OUTPUT", "live": live, "spec": json.dumps(placeholders)}
+    parts = {"url": normalize_url(spec["url"]), "sub": file_digest(spec["sub_path"]),
+             "font": spec.get("font_hash") or (file_digest(spec["font_path"]) if spec.get("font_path") else None),
+             "subset": bool(spec.get("subset")), "args": build_mux_cmd(template)[1:]}
+    if spec.get("tracks"): parts["subs"] = [file_digest(track["sub_path"]) for track in spec["tracks"][1:]]
+    if spec.get("fonts"): parts["fonts"] = [font["hash"] for font in spec["fonts"]]
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+def cache_path(key):
+    return os.path.join(CACHE_FOLDER, key + ".mkv")
+
+def link_or_copy(src, dst):
+    # Never write through an existing name: it may be a hardlink shared with the cache
+    try: os.remove(dst)
+    except OSError: pass
+    try: os.link(src, dst)
+    except OSError: shutil.copyfile(src, dst)
+
+def cache_lookup(key):
+    conn = db()
+    if not conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone(): return None
+    path = cache_path(key)
+    if not os.path.exists(path):
+        conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+        return None
+    conn.execute("UPDATE cache SET hits = hits + 1, last_used = ? WHERE key = ?", (time.time(), key))
+    return path
+
+def cache_store(key, output_path):
+    path = cache_path(key)
+    if not os.path.exists(path): link_or_copy(output_path, path)
+    now = time.time()
+    db().execute("INSERT INTO cache (key, size, created_at, last_used) VALUES (?, ?, ?, ?) "
+                 "ON CONFLICT(key) DO UPDATE SET size = excluded.size, last_used = excluded.last_used",
+                 (key, os.path.getsize(path), now, now))
+    evict_cache()
+
+def evict_cache():
+    # Least recently used first; users keep their own links to evicted entries
+    conn = db()
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+    for row in conn.execute("SELECT key, size FROM cache ORDER BY last_used").fetchall():
+        if total <= CACHE_MAX_BYTES: break
+        remove_cache_entry(row["key"])
+        total -= row["size"]
+
+def remove_cache_entry(key):
+    db().execute("DELETE FROM cache WHERE key = ?", (key,))
+    try: os.remove(cache_path(key))
+    except OSError: pass
+
+# --- FONT STORE ---
+# Uploaded fonts are stored once per content hash; each user only keeps a name -> hash mapping.
+FONT_EXTENSIONS = (".ttf", ".otf")
+
+def font_store_path(font_hash, ext):
+    return os.path.join(FONT_STORE, font_hash + ext)
+
+def add_font(uid, name, src_path):
+    # Moves src_path into the store (or drops it if the blob already exists) and maps name to it
+    ext = os.path.splitext(name)[1].lower()
+    font_hash = file_digest(src_path)
+    path = font_store_path(font_hash, ext)
+    if os.path.exists(path): os.remove(src_path)
+    else: os.replace(src_path, path)
+    db().execute("INSERT INTO fonts (uid, name, hash, ext, size, created_at, names) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                 "ON CONFLICT(uid, name) DO UPDATE SET hash = excluded.hash, ext = excluded.ext, size = excluded.size, names = excluded.names",
+                 (uid, name, font_hash, ext, os.path.getsize(path), time.time(), json.dumps(font_names(path))))
+    return font_hash, path
+
+def save_font_upload(uid, font_file):
+    name = os.path.basename(font_file.filename)
+    tmp = os.path.join(FONT_STORE, f".upload-{uuid.uuid4().hex}")
+    font_file.save(tmp)
+    return (name, *add_font(uid, name, tmp))
+
+def user_fonts(uid):
+    return [r["name"] for r in db().execute("SELECT name FROM fonts WHERE uid = ? ORDER BY name", (uid,))]
+
+def user_font(uid, name):
+    row = db().execute("SELECT * FROM fonts WHERE uid = ? AND name = ?", (uid, name)).fetchone()
+    return (row["hash"], font_store_path(row["hash"], row["ext"])) if row else (None, None)
+
+def font_names(path):
+    # Family, full and PostScript names: what libass matches a style's Fontname and \fn against
+    if font_tables is None: return []
+    try:
+        records = font_tables.TTFont(path, lazy=True)["name"].names
+    except Exception: return []
+    names = []
+    for record in sorted(records, key=lambda r: (1, 4, 6, 16).index(r.nameID) if r.nameID in (1, 4, 6, 16) else 9):
+        if record.nameID not in (1, 4, 6, 16): continue
+        try: name = record.toUnicode().strip()
+        except UnicodeDecodeError: continue
+        if name and name not in names: names.append(name)
+    return names
+
+def referenced_fonts(uid, wanted, attached):
+    # The user's saved fonts the scripts ask for by name, skipping hashes already attached -> [{path, hash, name}]
+    wanted = {name.lower() for name in wanted}
+    picked = []
+    for row in db().execute("SELECT * FROM fonts WHERE uid = ? ORDER BY name", (uid,)).fetchall():
+        if row["hash"] in attached: continue
+        path = font_store_path(row["hash"], row["ext"])
+        if row["names"] is None:  # saved before names were recorded
+            names = font_names(path)
+            db().execute("UPDATE fonts SET names = ? WHERE uid = ? AND name = ?", (json.dumps(names), uid, row["name"]))
+        else: names = json.loads(row["names"])
+        if ({n.lower() for n in names} | {os.path.splitext(row["name"])[0].lower()}) & wanted:
+            picked.append({"path": path, "hash": row["hash"], "name": row["name"]})
+            attached.add(row["hash"])
+    return picked
+
+def import_legacy_fonts():
+    # One-time move of fonts/{uid}_{name} files into the store
+    conn = db()
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'fonts_imported'").fetchone(): return
+    for f in sorted(os.listdir(FONT_FOLDER)):
+        path = os.path.join(FONT_FOLDER, f)
+        if "_" not in f or not os.path.isfile(path) or not f.lower().endswith(FONT_EXTENSIONS): continue
+        uid, name = f.split("_", 1)
+        try: add_font(uid, name, path)
+        except OSError as e: app.logger.warning("could not import font %s: %s", f, e)
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('fonts_imported', ?)", (str(time.time()),))
+
+ASS_OVERRIDE_RE = re.compile(r"\{[^}]*\}")
+
+def ass_glyphs(sub_path):
+    # Every character the [Events] section can draw, override blocks and escapes removed
+    chars = set()
+    with open(sub_path, 'r', encoding='utf-8-sig', errors='ignore') as f:
+        for line in f:
+            if not line.startswith("Dialogue:"): continue
+            text = line.rstrip("\r\n").split(",", 9)[-1]
+            text = ASS_OVERRIDE_RE.sub("", text).replace("\\N", " ").replace("\\n", " ").replace("\\h", " ")
+            chars.update(text)
+    return chars
+
+def subset_font(font_path, font_hash, sub_paths):
+    # Trims the attachment to the glyphs the scripts use; cached per (font hash, glyph set)
+    if font_subset is None: return font_path
+    try:
+        glyphs = "".join(sorted(set(" ?").union(*map(ass_glyphs, sub_paths))))
+        ext = os.path.splitext(font_path)[1].lower()
+        glyph_hash = hashlib.sha256(glyphs.encode("utf-8")).hexdigest()[:16]
+        out = os.path.join(FONT_SUBSET_FOLDER, f"{font_hash}_{glyph_hash}{ext}")
+        if os.path.exists(out):
+            os.utime(out)  # the sweeper expires subsets by mtime
+            return out
+        options = font_subset.Options()
+        options.layout_features = ["*"]
+        options.name_IDs = ["*"]
+        options.name_languages = ["*"]
+        options.notdef_outline = True
+        font = font_subset.load_font(font_path, options)
+        subsetter = font_subset.Subsetter(options)
+        subsetter.populate(text=glyphs)
+        subsetter.subset(font)
+        tmp = out + f".{uuid.uuid4().hex}.tmp"
+        font_subset.save_font(font, tmp, options)
+        os.replace(tmp, out)
+        return out
+    except Exception as e:
+        app.logger.warning("font subsetting failed for %s, attaching full font: %s", font_path, e)
+        return font_path
+
+# --- SUBTITLE INGEST ---
+# Every uploaded script is sniffed (ASS/SSA, SRT or WebVTT), decoded to UTF-8, converted to ASS when it is
+# SRT/VTT and checked for what libass needs before a job is queued, line by line. The result (or the reason
+# it was refused) is kept per content hash, so uploading the same file again only costs the hash.
+SUB_EXTENSIONS = (".ass", ".ssa", ".srt", ".vtt")
+SUB_INGEST_VERSION = 1  # part of the cache key: bump when the output of the ingest changes
+ASS_STYLE_FIELDS = ("Name", "Fontname", "Fontsize", "PrimaryColour", "SecondaryColour", "OutlineColour", "BackColour", "Bold", "Italic",
+                    "Underline", "StrikeOut", "ScaleX", "ScaleY", "Spacing", "Angle", "BorderStyle", "Outline", "Shadow", "Alignment",
+                    "MarginL", "MarginR", "MarginV", "Encoding")
+ASS_DEFAULT_STYLE = dict(Name="Default", Fontname="Arial", Fontsize="64", PrimaryColour="&H00FFFFFF", SecondaryColour="&H000000FF",
+                         OutlineColour="&H00000000", BackColour="&H80000000", Bold="0", Italic="0", Underline="0", StrikeOut="0",
+                         ScaleX="100", ScaleY="100", Spacing="0", Angle="0", BorderStyle="1", Outline="3", Shadow="1", Alignment="2",
+                         MarginL="60", MarginR="60", MarginV="50", Encoding="1")
+ASS_TIME_RE = re.compile(r"\d+:\d{2}:\d{2}\.\d{2}")
+ASS_FONT_OVERRIDE_RE = re.compile(r"\\fn([^\\}]*)")
+CUE_TIMING_RE = re.compile(r"\s*((?:\d+:)?\d{1,2}:\d{2}[,.]\d{1,3})\s*-->\s*((?:\d+:)?\d{1,2}:\d{2}[,.]\d{1,3})")
+CUE_TAG_RE = re.compile(r"<(/?)([a-zA-Z]+)([^>]*)>|<[^>]*>")
+CUE_COLOR_RE = re.compile(r"color\s*=\s*[\"']?#([0-9a-fA-F]{6})")
+
+def sub_encoding(path):
+    # Byte order mark, else UTF-8 if the start decodes as such, else a guess
+    with open(path, 'rb') as f: sample = f.read(64 * 1024)
+    for bom, encoding in ((codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"), (codecs.BOM_UTF8, "utf-8-sig"),
+                          (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")):
+        if sample.startswith(bom): return encoding
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample)  # not final: a character cut at the end is fine
+        return "utf-8"
+    except UnicodeDecodeError: pass
+    if charset_normalizer:
+        guess = charset_normalizer.from_bytes(sample).best()
+        if guess: return guess.encoding
+    return SUB_FALLBACK_ENCODING
+
+def sub_format(head):
+    # First lines of the decoded file -> "ass", "vtt", "srt" or None
+    text = [line.strip() for line in head if line.strip()]
+    if not text: return None
+    if text[0].startswith("WEBVTT"): return "vtt"
+    if text[0].startswith("[") or any(line.lower() == "[script info]" for line in text): return "ass"
+    if any(CUE_TIMING_RE.match(line) for line in text): return "srt"
+    return None
+
+def sub_style():
+    # Style for converted cues: fonts/default.ttf's family unless SUB_STYLE says otherwise
+    style = dict(ASS_DEFAULT_STYLE)
+    default_names = font_names(os.path.join(FONT_FOLDER, "default.ttf"))
+    if default_names: style["Fontname"] = default_names[0]
+    for item in SUB_STYLE.split(","):
+        key, _, value = item.partition("=")
+        if key.strip() in style and value.strip(): style[key.strip()] = value.strip()
+    return style
+
+def cue_seconds(stamp):
+    *rest, seconds = stamp.replace(",", ".").split(":")
+    total = 0
+    for part in rest: total = total * 60 + int(part)
+    return total * 60 + float(seconds)
+
+def ass_time(seconds):
+    h, cs = divmod(round(seconds * 100), 360000)
+    m, cs = divmod(cs, 6000)
+    s, cs = divmod(cs, 100)
+    return f"{h}:{m:02}:{s:02}.{cs:02}"
+
+def cue_text(lines):
+    # SRT/VTT markup -> ASS overrides; <i>, <b>, <u>, <s> and <font color> survive, other tags are dropped.
+    # Braces are kept on purpose: SRT files often carry ASS overrides like {\an8} that libass honours.
+    def tag(m):
+        closing, name, attrs = m.group(1), (m.group(2) or "").lower(), m.group(3) or ""
+        if name in ("i", "b", "u", "s"): return f"{{\\{name}{0 if closing else 1}}}"
+        if name == "font" and closing: return "{\\c}"
+        color = CUE_COLOR_RE.search(attrs) if name == "font" else None
+        if color:
+            rgb = color.group(1)
+            return f"{{\\c&H{rgb[4:6]}{rgb[2:4]}{rgb[0:2]}&}}"
+        return ""
+    return html.unescape(CUE_TAG_RE.sub(tag, "\\N".join(lines)))
+
+def cues_to_ass(lines, style):
+    # Streams SRT or WebVTT cues out as an ASS script with a single style
+    yield from ("[Script Info]", "; Converted from SRT/WebVTT on upload", "ScriptType: v4.00+", "PlayResX: 1920", "PlayResY: 1080",
+                "WrapStyle: 0", "ScaledBorderAndShadow: yes", "", "[V4+ Styles]", "Format: " + ", ".join(ASS_STYLE_FIELDS),
+                "Style: " + ",".join(style[k] for k in ASS_STYLE_FIELDS), "", "[Events]",
+                "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text")
+    block = []
+    for number, line in enumerate(itertools.chain(lines, [""]), 1):
+        line = line.rstrip("\r\n")
+        if line.strip():
+            block.append((number, line))
+            continue
+        timing = next((i for i, (_, text) in enumerate(block) if "-->" in text), None)
+        # Blocks without a timing line are the WEBVTT header, NOTE, STYLE and REGION blocks or stray numbers
+        if timing is not None and not block[0][1].startswith(("NOTE", "STYLE", "REGION")):
+            m = CUE_TIMING_RE.match(block[timing][1])
+            if not m: raise ValueError(f"line {block[timing][0]}: unreadable cue timing")
+            start, end = cue_seconds(m.group(1)), cue_seconds(m.group(2))
+            yield f"Dialogue: 0,{ass_time(start)},{ass_time(end)},Default,,0,0,0,,{cue_text([text for _, text in block[timing + 1:]])}"
+        block = []
+
+def check_ass(lines, info):
+    # Passes the script through while checking its structure; collects the fonts it uses into info["fonts"].
+    # ValueError (with the line number) for anything libass would choke on.
+    section, formats, styles, used, fonts = None, {}, {}, set(), set()
+    sections, dialogues = set(), 0
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        stripped = line.strip()
+        if stripped.startswith("[") and stripped.endswith("]"):
+            section = stripped.lower()
+            sections.add(section)
+        elif section in ("[v4+ styles]", "[v4 styles]", "[events]") and ":" in stripped:
+            kind, _, value = stripped.partition(":")
+            if kind == "Format": formats[section] = [field.strip().lower() for field in value.split(",")]
+            elif kind == "Style" or (kind == "Dialogue" and section == "[events]"):
+                fields = formats.get(section)
+                if not fields: raise ValueError(f"line {number}: {kind} before the Format line")
+                row = dict(zip(fields, value.lstrip().split(",", len(fields) - 1)))
+                if len(row) != len(fields): raise ValueError(f"line {number}: {kind} has {len(row)} of {len(fields)} fields")
+                if kind == "Style": styles[row.get("name", "").strip()] = row.get("fontname", "").strip().lstrip("@")
+                else:
+                    if not (ASS_TIME_RE.fullmatch(row.get("start", "").strip()) and ASS_TIME_RE.fullmatch(row.get("end", "").strip())):
+                        raise ValueError(f"line {number}: unreadable start or end time")
+                    used.add(row.get("style", "").strip().lstrip("*"))
+                    fonts.update(name.strip().lstrip("@") for name in ASS_FONT_OVERRIDE_RE.findall(row.get("text", "")))
+                    dialogues += 1
+        yield line
+    for name, present in (("[Script Info]", "[script info]" in sections), ("[V4+ Styles]", sections & {"[v4+ styles]", "[v4 styles]"}),
+                          ("[Events]", "[events]" in sections)):
+        if not present: raise ValueError(f"the {name} section is missing")
+    if not dialogues: raise ValueError("[Events] has no Dialogue lines")
+    undefined = sorted(used - set(styles))
+    if undefined: info["warnings"].append(f"undefined styles (libass falls back to Default): {', '.join(undefined)}")
+    fonts.update(styles[name] for name in used | ({"Default"} if undefined else set()) if name in styles)
+    info["fonts"] = sorted(filter(None, fonts))
+
+def ingest_subtitle(path):
+    # Replaces the upload at path with its UTF-8 ASS form -> info dict like run_probe's, plus format, encoding and fonts
+    key = hashlib.sha256(f"{file_digest(path)}:{SUB_INGEST_VERSION}:{SUB_STYLE}".encode()).hexdigest()
+    cached_path = os.path.join(SUB_CACHE_FOLDER, key + ".ass")
+    conn = db()
+    row = conn.execute("SELECT * FROM subtitles WHERE hash = ?", (key,)).fetchone()
+    if row and (not row["ok"] or os.path.exists(cached_path)):
+        conn.execute("UPDATE subtitles SET last_used = ? WHERE hash = ?", (time.time(), key))
+        if row["ok"]: link_or_copy(cached_path, path)
+        return dict(json.loads(row["info"]), cached=True)
+
+    info = {"ok": False, "error": None, "format": None, "encoding": None, "fonts": [], "warnings": []}
+    tmp = cached_path + f".{uuid.uuid4().hex}.tmp"
+    try:
+        info["encoding"] = sub_encoding(path)
+        with open(path, 'r', encoding=info["encoding"], errors="replace") as src, open(tmp, 'w', encoding="utf-8", newline="\n") as out:
+            head = list(itertools.islice(src, 20))
+            info["format"] = sub_format(head)
+            if not info["format"]: raise ValueError("not a subtitle script (expected ASS, SRT or WebVTT)")
+            lines = itertools.chain(head, src)
+            if info["format"] != "ass": lines = cues_to_ass(lines, sub_style())
+            undecodable = 0
+            for line in check_ass(lines, info):
+                undecodable += line.count("\ufffd")
+                out.write(line + "\n")
+        if undecodable: info["warnings"].append(f"{undecodable} characters could not be read as {info['encoding']}")
+        os.replace(tmp, cached_path)
+        link_or_copy(cached_path, path)
+        info["ok"] = True
+    except (ValueError, LookupError) as e:  # LookupError: a guessed encoding Python does not know
+        info["error"] = str(e)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+    now = time.time()
+    conn.execute("INSERT INTO subtitles (hash, ok, info, created_at, last_used) VALUES (?, ?, ?, ?, ?) "
+                 "ON CONFLICT(hash) DO UPDATE SET ok = excluded.ok, info = excluded.info, last_used = excluded.last_used",
+                 (key, int(info["ok"]), json.dumps(info), now, now))
+    return dict(info, cached=False)
+
+# --- PROBE SERVICE ---
+# Sources are checked with ffprobe before a job is queued. Results are cached per normalized URL,
+# failures only briefly, so the form can validate as the user types.
+def run_probe(url):
+    started = time.time()
+    cmd = [FFPROBE_BIN, '-v', 'error', '-headers', f'Referer: {url}', '-tls_verify', '0',
+           '-rw_timeout', str(int(PROBE_TIMEOUT * 1e6)), '-show_format', '-show_streams', '-of', 'json', url]
+    info = {"ok": False, "error": None, "duration": None, "container": None, "size": None, "bit_rate": None, "streams": []}
+    try:
+        res = subprocess.run(cmd, capture_output=True, timeout=PROBE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        info["error"] = f"Source did not answer within {PROBE_TIMEOUT:g}s"
+        return info
+    except OSError as e:
+        info["error"] = f"Could not run ffprobe: {e}"
+        return info
+    finally:
+        info["elapsed"] = round(time.time() - started, 3)
+    if res.returncode != 0:
+        lines = res.stderr.decode('utf-8', 'ignore').strip().splitlines()
+        info["error"] = lines[-1] if lines else "ffprobe failed"
+        return info
+    try: data = json.loads(res.stdout or b"{}")
+    except ValueError:
+        info["error"] = "Unreadable ffprobe output"
+        return info
+    fmt = data.get("format", {})
+    try: info["duration"] = float(fmt["duration"])
+    except (KeyError, ValueError): pass
+    info["container"] = fmt.get("format_name")
+    info["size"] = int(fmt["size"]) if str(fmt.get("size", "")).isdigit() else None
+    info["bit_rate"] = int(fmt["bit_rate"]) if str(fmt.get("bit_rate", "")).isdigit() else None
+    for st in data.get("streams", []):
+        info["streams"].append({"index": st.get("index"), "type": st.get("codec_type"), "codec": st.get("codec_name"),
+                                "language": st.get("tags", {}).get("language"),
+                                "attached_pic": bool(st.get("disposition", {}).get("attached_pic"))})
+    # The mux maps 0:V and 0:a, so both must exist
+    if not any(st["type"] == "video" and not st["attached_pic"] for st in info["streams"]): info["error"] = "Source has no video stream"
+    elif not any(st["type"] == "audio" for st in info["streams"]): info["error"] = "Source has no audio stream"
+    else: info["ok"] = True
+    return info
+
+def probe_source(url):
+    key = normalize_url(url)
+    conn = db()
+    row = conn.execute("SELECT * FROM probes WHERE url = ?", (key,)).fetchone()
+    if row and time.time() - row["probed_at"] < (PROBE_TTL if row["ok"] else PROBE_ERROR_TTL):
+        return dict(json.loads(row["info"]), cached=True)
+    info = run_probe(url)
+    conn.execute("INSERT INTO probes (url, ok, info, probed_at) VALUES (?, ?, ?, ?) "
+                 "ON CONFLICT(url) DO UPDATE SET ok = excluded.ok, info = excluded.info, probed_at = excluded.probed_at",
+                 (key, int(info["ok"]), json.dumps(info), time.time()))
+    if info["ok"]: record_origin_probe(url, info)
+    return dict(info, cached=False)
+
+# --- ORIGIN PROFILES ---
+# Every fresh probe and every finished attempt adds a sample to its source host's row in origins:
+# running averages of open latency, probe time, reconnects and throughput, plus how often the stream
+# layout changed. Once a host has ORIGIN_MIN_SAMPLES, new attempts get input settings picked from its
+# profile (origin_settings); values pinned on /admin/origins win over learned ones, null = ffmpeg's default.
+ORIGIN_PROBE_FLAGS = ("probesize", "analyzeduration")  # demuxer options: they apply to prefetched copies too
+ORIGIN_FFMPEG_FLAGS = ORIGIN_PROBE_FLAGS + ("rw_timeout", "reconnect_delay_max", "reconnect_on_network_error")
+ORIGIN_SETTINGS = ORIGIN_FFMPEG_FLAGS + ("start_buffer",)  # start_buffer: bytes spooled before a prefetched stream is muxed
+ORIGIN_RECONNECT_RE = re.compile(rb"Will reconnect at \d+")  # logged by ffmpeg's http protocol for every reconnect
+
+def origin_host(url):
+    return urlsplit(normalize_url(url)).netloc
+
+def stream_layout(streams):
+    return ",".join(f"{st['type']}:{st['codec']}" for st in streams if not st.get("attached_pic"))
+
+def count_reconnects(log_path):
+    try:
+        with open(log_path, 'rb') as f: return len(ORIGIN_RECONNECT_RE.findall(f.read()))
+    except OSError: return 0
+
+def running_average(column):
+    # New sample in excluded.<column>; a NULL sample leaves the average as it was
+    return f"{column} = COALESCE({column} + {ORIGIN_WEIGHT} * (excluded.{column} - {column}), excluded.{column}, {column})"
+
+def record_origin_probe(url, info):
+    host = origin_host(url)
+    if not host: return
+    db().execute(
+        "INSERT INTO origins (host, probes, probe_seconds, layout, layout_runs, updated_at) VALUES (?, 1, ?, ?, 1, ?) "
+        f"ON CONFLICT(host) DO UPDATE SET probes = probes + 1, {running_average('probe_seconds')}, "
+        "layout_changes = layout_changes + (layout IS NOT NULL AND layout != excluded.layout), "
+        "layout_runs = CASE WHEN layout = excluded.layout THEN layout_runs + 1 ELSE 1 END, "
+        "layout = excluded.layout, updated_at = excluded.updated_at",
+        (host, info["elapsed"], stream_layout(info["streams"]), time.time()))
+
+def record_origin_job(job, rc, tail, prefetch):
+    spec = json.loads(job["spec"])
+    host = origin_host(spec["url"])
+    if not host or spec.get("input_args"): return  # the join of resumed parts only reads local files
+    failed = rc != 0 and (isinstance(rc, int) or bool(prefetch and prefetch.error))
+    if rc != 0 and not failed: return  # interrupted on our side, says nothing about the origin
+    if prefetch: opened, reconnects, throughput = prefetch.opened_in, prefetch.retries, prefetch.throughput
+    else: opened, reconnects, throughput = tail.open_seconds, count_reconnects(tail.log_path), tail.throughput
+    db().execute(
+        "INSERT INTO origins (host, jobs, failures, open_seconds, reconnects, throughput, updated_at) VALUES (?, 1, ?, ?, ?, ?, ?) "
+        f"ON CONFLICT(host) DO UPDATE SET jobs = jobs + 1, failures = failures + excluded.failures, {running_average('open_seconds')}, "
+        f"{running_average('reconnects')}, {running_average('throughput')}, updated_at = excluded.updated_at",
+        (host, int(failed), opened, reconnects, None if failed else throughput or None, time.time()))
+
+def learned_settings(row):
+    settings = {}
+    if row["layout_runs"] >= ORIGIN_MIN_SAMPLES:
+        # The same streams every time: a short look finds them all
+        settings.update(probesize=2 * 1024 ** 2, analyzeduration=2 * 10 ** 6)
+    elif row["layout_changes"]:
+        # Streams that come and go: look further before settling on a layout
+        settings.update(probesize=32 * 1024 ** 2, analyzeduration=15 * 10 ** 6)
+    if row["jobs"] < ORIGIN_MIN_SAMPLES: return settings
+    if row["open_seconds"] is not None:
+        # A read stalled for a few times the usual open latency is dead: fail it so -reconnect starts over
+        settings["rw_timeout"] = int(min(max(row["open_seconds"] * 5, 15), 120) * 10 ** 6)
+    flaky = (row["reconnects"] or 0) >= 0.5 or row["failures"] * 4 >= row["jobs"]
+    if flaky:
+        # Reconnect on network errors too, and retry well before the 120 s backoff ceiling; spool more first
+        settings.update(reconnect_on_network_error=1, reconnect_delay_max=10, start_buffer=2 * PREFETCH_START_BYTES)
+    elif row["throughput"] and row["throughput"] * 5 < PREFETCH_START_BYTES:
+        # Steady but slow: start muxing after ~5 s worth instead of waiting for the whole default buffer
+        settings["start_buffer"] = max(int(row["throughput"] * 5), PREFETCH_CHUNK)
+    return settings
+
+def origin_settings(row):
+    # -> (learned, in effect): pinned values replace learned ones, a pinned null drops the setting
+    learned = learned_settings(row)
+    settings = dict(learned, **json.loads(row["pinned"] or "{}"))
+    return learned, {k: v for k, v in settings.items() if v is not None}
+
+def input_tuning(url):
+    row = db().execute("SELECT * FROM origins WHERE host = ?", (origin_host(url),)).fetchone()
+    return origin_settings(row)[1] if row else {}
+
+def pin_origin(host, pinned):
+    db().execute("INSERT INTO origins (host, pinned, updated_at) VALUES (?, ?, ?) ON CONFLICT(host) DO UPDATE SET pinned = excluded.pinned",
+                 (host, json.dumps(pinned) if pinned else None, time.time()))
+
+# --- UPLOAD STAGING ---
+# Every job gets its own uploads/jobs/<key>/ directory, removed when the job finishes or is cancelled.
+# Large files can arrive through resumable uploads in uploads/incoming/<id> first (tus-style:
+# POST creates, HEAD reports Upload-Offset, PATCH appends from that offset) and are moved in at submit.
+UPLOAD_CHUNK = 64 * 1024
+
+def new_staging_dir():
+    path = os.path.join(STAGING_FOLDER, uuid.uuid4().hex)
+    os.makedirs(path)
+    return path
+
+def remove_staged_inputs(spec):
+    if spec.get("staging"): shutil.rmtree(spec["staging"], ignore_errors=True)
+    elif spec.get("sub_path"):  # jobs queued before per-job staging
+        try: os.remove(spec["sub_path"])
+        except OSError: pass
+
+def incoming_path(upload_id):
+    return os.path.join(INCOMING_FOLDER, upload_id)
+
+def upload_get(uid, upload_id):
+    return db().execute("SELECT * FROM uploads WHERE id = ? AND uid = ?", (upload_id, uid)).fetchone()
+
+def take_upload(uid, upload_id, dest):
+    # Moves a completed resumable upload to dest and returns its original filename
+    row = upload_get(uid, upload_id)
+    if not row or row["offset"] != row["size"]: return None
+    os.replace(incoming_path(upload_id), dest)
+    db().execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+    return row["filename"]
+
+def expire_uploads():
+    conn = db()
+    for row in conn.execute("SELECT id FROM uploads WHERE updated_at < ?", (time.time() - UPLOAD_TTL,)).fetchall():
+        try: os.remove(incoming_path(row["id"]))
+        except OSError: pass
+        conn.execute("DELETE FROM uploads WHERE id = ?", (row["id"],))
+
+# --- METRICS ---
+# Counters and histograms live in the metrics table so every gunicorn worker adds to the same series.
+# Job metrics are written when a job ends; route timings are buffered in memory and flushed every
+# METRICS_FLUSH_INTERVAL. Gauges are aggregate queries over the registry, never directory walks.
+METRICS = {
+    "muxer_jobs_submitted_total": ("counter", "Jobs submitted, by whether the result cache answered them", None),
+    "muxer_jobs_finished_total": ("counter", "Jobs that reached a final state", None),
+    "muxer_output_bytes_total": ("counter", "Bytes written to finished outputs", None),
+    "muxer_gc_removed_total": ("counter", "Outputs and stray files removed by the storage sweeper", None),
+    "muxer_job_duration_seconds": ("histogram", "Wall time from claim to finish of successful jobs", JOB_DURATION_BUCKETS),
+    "muxer_job_throughput_bytes_per_second": ("histogram", "Output bytes per second of successful jobs", JOB_THROUGHPUT_BUCKETS),
+    "muxer_job_speed_ratio": ("histogram", "Final ffmpeg speed= (media seconds per wall second) of successful jobs", JOB_SPEED_BUCKETS),
+    "muxer_request_duration_seconds": ("histogram", "Time until a route returns its response", ROUTE_LATENCY_BUCKETS),
+}
+_pending_metrics = {}
+_pending_lock = threading.Lock()
+_last_flush = time.time()
+
+def histogram_samples(name, value, labels=""):
+    # (name, labels) -> increment for one observation; buckets are stored cumulative like the exposition format
+    sep = "," if labels else ""
+    samples = {(f"{name}_bucket", f'{labels}{sep}le="{le}"'): 1 for le in METRICS[name][2] if value <= le}
+    samples[(f"{name}_bucket", f'{labels}{sep}le="+Inf"')] = 1
+    samples[(f"{name}_sum", labels)] = value
+    samples[(f"{name}_count", labels)] = 1
+    return samples
+
+def write_metrics(samples):
+    db().executemany("INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) "
+                     "ON CONFLICT(name, labels) DO UPDATE SET value = value + excluded.value",
+                     [(name, labels, value) for (name, labels), value in samples.items()])
+
+def metric_add(name, labels="", value=1):
+    write_metrics({(name, labels): value})
+
+def metric_observe(name, value, labels=""):
+    write_metrics(histogram_samples(name, value, labels))
+
+def record_job_finished(job, fields):
+    state = fields.get("state", "done")
+    samples = {("muxer_jobs_finished_total", f'state="{state}"'): 1}
+    if state == "done" and job["started_at"]:
+        elapsed = max(time.time() - job["started_at"], 0.001)
+        size = fields.get("size") or 0
+        samples[("muxer_output_bytes_total", "")] = size
+        samples.update(histogram_samples("muxer_job_duration_seconds", elapsed))
+        samples.update(histogram_samples("muxer_job_throughput_bytes_per_second", size / elapsed))
+        if fields.get("speed"): samples.update(histogram_samples("muxer_job_speed_ratio", fields["speed"]))
+    write_metrics(samples)
+
+def observe_request(route, seconds):
+    with _pending_lock:
+        for key, value in histogram_samples("muxer_request_duration_seconds", seconds, f'route="{route}"').items():
+            _pending_metrics[key] = _pending_metrics.get(key, 0) + value
+        due = time.time() - _last_flush >= METRICS_FLUSH_INTERVAL
+    if due: flush_metrics()
+
+def flush_metrics():
+    global _pending_metrics, _last_flush
+    with _pending_lock:
+        pending, _pending_metrics, _last_flush = _pending_metrics, {}, time.time()
+    if pending: write_metrics(pending)
+
+atexit.register(flush_metrics)
+
+def render_metrics():
+    conn = db()
+    stored = {(r["name"], r["labels"]): r["value"] for r in conn.execute("SELECT name, labels, value FROM metrics")}
+    lines = []
+    def emit(name, kind, help_text, samples):
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+        for n, labels, value in samples:
+            value = int(value) if float(value).is_integer() else value  # exact byte counts, no 1.23e+09
+            lines.append(f"{n}{{{labels}}} {value}" if labels else f"{n} {value}")
+
+    for name, (kind, help_text, buckets) in METRICS.items():
+        if kind == "counter":
+            emit(name, kind, help_text, [(name, labels, value) for (n, labels), value in sorted(stored.items()) if n == name])
+            continue
+        samples = []
+        for labels in sorted(l for n, l in stored if n == f"{name}_count"):
+            sep = "," if labels else ""
+            for le in (*buckets, "+Inf"):
+                bucket = f'{labels}{sep}le="{le}"'
+                samples.append((f"{name}_bucket", bucket, stored.get((f"{name}_bucket", bucket), 0)))
+            samples.append((f"{name}_sum", labels, stored[(f"{name}_sum", labels)]))
+            samples.append((f"{name}_count", labels, stored[(f"{name}_count", labels)]))
+        emit(name, kind, help_text, samples)
+
+    states = dict.fromkeys(("queued", "retrying", "processing", "cancelling", "done", "error"), 0)
+    states.update({r["state"]: r["n"] for r in conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")})
+    emit("muxer_jobs", "gauge", "Jobs in the registry by state (processing = running ffmpeg)",
+         [("muxer_jobs", f'state="{state}"', n) for state, n in states.items()])
+    waiting = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND prepared != 1").fetchone()[0]
+    emit("muxer_jobs_unprobed", "gauge", "Queued batch jobs still waiting for their source probe", [("muxer_jobs_unprobed", "", waiting)])
+    # Sizes as tracked by the registry; outputs hardlinked from the cache are counted in both folders
+    folders = {
+        "downloads": "SELECT COALESCE(SUM(size), 0) FROM jobs",
+        "cache": "SELECT COALESCE(SUM(size), 0) FROM cache",
+        "fonts": "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(size) AS size FROM fonts GROUP BY hash)",
+        "uploads": 'SELECT COALESCE(SUM("offset"), 0) FROM uploads',
+    }
+    emit("muxer_folder_bytes", "gauge", "Bytes stored per data folder",
+         [("muxer_folder_bytes", f'folder="{folder}"', conn.execute(sql).fetchone()[0]) for folder, sql in folders.items()])
+    return "\n".join(lines) + "\n"
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_timer(response):
+    # Streamed responses (live downloads) are timed until their first byte is ready to send
+    if request.endpoint in TIMED_ROUTES and "request_started" in g:
+        observe_request(request.endpoint, time.perf_counter() - g.request_started)
+    return response
+
+# --- COMPRESSION ---
+def response_encoding():
+    accepted = request.accept_encodings
+    if brotli and accepted["br"]: return "br"
+    return "gzip" if accepted["gzip"] else None
+
+def compress(data, encoding):
+    return brotli.compress(data, quality=5) if encoding == "br" else gzip.compress(data, compresslevel=6)
+
+@app.after_request
+def compress_response(response):
+    # Text bodies only; files and streams (downloads, live output, SSE) go out as they are
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200 or
+            "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = response_encoding()
+    data = response.get_data()
+    if encoding and len(data) >= COMPRESS_MIN_BYTES:
+        response.set_data(compress(data, encoding))
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+# --- PREFETCH ---
+# Range-capable HTTP sources are pulled with PREFETCH_CONNECTIONS parallel ranged requests into a spool
+# file in the job's staging dir, so a CDN that caps each connection no longer caps the job. HLS media
+# playlists get their segments fetched the same way plus a local playlist. The sha256 of every piece is
+# kept in a manifest and checked again before the piece reaches ffmpeg; a mismatch is fetched again.
+TLS_CONTEXT = ssl._create_unverified_context()  # same trust as ffmpeg's -tls_verify 0
+HLS_EXTENSIONS = (".ts", ".m4s", ".mp4", ".aac", ".m4a", ".mp3", ".vtt")
+FETCH_ERRORS = (OSError, ValueError, http.client.HTTPException)
+
+def http_open(url, start=None, end=None, referer=None):
+    headers = {"Referer": referer or url}
+    if start is not None: headers["Range"] = f"bytes={start}-{end}"
+    return urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=PREFETCH_TIMEOUT, context=TLS_CONTEXT)
+
+def start_prefetch(url, staging, start_bytes=None):
+    # -> running Prefetch, or None when the source is better left to ffmpeg
+    if urlsplit(url).scheme.lower() not in ("http", "https"): return None
+    began = time.time()
+    try:
+        with http_open(url, 0, 4095) as r:  # enough to tell ranged file, HLS playlist or neither
+            head = r.read(4096)
+            total = r.headers.get("Content-Range", "").rpartition("/")[2]
+            final_url = r.geturl()
+        opened_in = time.time() - began
+    except FETCH_ERRORS as e:
+        app.logger.info("no prefetch for %s: %s", url, e)
+        return None
+    if head.lstrip().startswith(b"#EXTM3U"):
+        try:
+            with http_open(final_url, referer=url) as r: playlist = r.read().decode("utf-8", "replace")
+        except FETCH_ERRORS: return None
+        prefetch = hls_prefetch(url, final_url, playlist, staging)
+        if not prefetch: return None
+    elif r.status == 206 and total.isdigit() and int(total) > 2 * PREFETCH_CHUNK:
+        size = int(total)
+        pieces = [{"url": final_url, "path": os.path.join(staging, "source.spool"), "start": off, "end": min(off + PREFETCH_CHUNK, size) - 1}
+                  for off in range(0, size, PREFETCH_CHUNK)]
+        with open(pieces[0]["path"], "ab") as f: f.truncate(size)
+        prefetch = Prefetch(url, staging, pieces)
+    else: return None
+    prefetch.opened_in = opened_in
+    if start_bytes: prefetch.start_bytes = start_bytes
+    prefetch.start()
+    return prefetch
+
+def hls_prefetch(url, playlist_url, playlist, staging):
+    # VOD media playlists only: master playlists, live playlists, encryption and byte ranges stay with ffmpeg
+    if "#EXT-X-ENDLIST" not in playlist or any(tag in playlist for tag in ("#EXT-X-STREAM-INF", "#EXT-X-BYTERANGE")): return None
+    if re.search(r"#EXT-X-KEY:(?!.*METHOD=NONE)", playlist): return None
+    folder = os.path.join(staging, "hls")
+    os.makedirs(folder, exist_ok=True)
+    pieces, lines = [], []
+
+    def local(uri):
+        ext = os.path.splitext(urlsplit(uri).path)[1].lower()
+        name = f"seg{len(pieces):05d}{ext if ext in HLS_EXTENSIONS else '.ts'}"
+        pieces.append({"url": urljoin(playlist_url, uri), "path": os.path.join(folder, name), "start": None, "end": None})
+        return name
+
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-MAP:"):
+            line = re.sub(r'URI="([^"]+)"', lambda m: f'URI="{local(m.group(1))}"', line)
+        elif line and not line.startswith("#"):
+            line = local(line)
+        lines.append(line)
+    if not pieces: return None
+    # A remote playlist must not reach local files (file://...) through us; ffmpeg's HLS demuxer refuses them too
+    if any(urlsplit(piece["url"]).scheme.lower() not in ("http", "https") for piece in pieces): return None
+    input_path = os.path.join(folder, "index.m3u8")
+    with open(input_path, "w") as f: f.write("\n".join(lines) + "\n")
+    return Prefetch(url, staging, pieces, input_path=input_path)
+
+class Prefetch:
+    def __init__(self, url, staging, pieces, input_path=None):
+        self.url = url
+        self.pieces = pieces
+        self.input_path = input_path or pieces[0]["path"]
+        self.manifest_path = os.path.join(staging, "source.chunks.json")
+        self.cond = threading.Condition()
+        self.hashes = {}  # piece index -> sha256 of what is on disk
+        self.stopped = False
+        self.error = None
+        self.fetchers = 0
+        self.streamable = None  # decided from the first bytes of a spool
+        self.input = None  # what ffmpeg reads, set once ready(): "pipe:0" fed by feed(), or a local file
+        self.start_bytes = PREFETCH_START_BYTES
+        # For the origin profile: latency of the first request, failed attempts, bytes pulled this time
+        self.opened_in = None
+        self.retries = 0
+        self.fetched = 0
+        self.started = time.time()
+        self.last_fetch = None
+        # A previous attempt for this job may have left verified pieces behind
+        try:
+            with open(self.manifest_path) as f: manifest = json.load(f)
+            if manifest.get("url") == url and manifest.get("pieces") == len(pieces):
+                self.hashes = {int(i): h for i, h in manifest["hashes"].items() if self.digest(int(i)) == h}
+        except (OSError, ValueError): pass
+        self.pending = [i for i in range(len(pieces)) if i not in self.hashes]
+
+    @property
+    def spooled(self):
+        return self.pieces[0]["start"] is not None
+
+    @property
+    def complete(self):
+        return len(self.hashes) == len(self.pieces)
+
+    @property
+    def total(self):
+        # Spool size for ranged sources; HLS segment sizes are only known once fetched
+        return self.pieces[-1]["end"] + 1 if self.spooled else None
+
+    @property
+    def on_disk(self):
+        with self.cond: done = list(self.hashes)
+        if self.spooled: return sum(self.pieces[i]["end"] - self.pieces[i]["start"] + 1 for i in done)
+        total = 0
+        for i in done:
+            try: total += os.path.getsize(self.pieces[i]["path"])
+            except OSError: pass
+        return total
+
+    @property
+    def throughput(self):
+        # Bytes/s over all connections; None when every piece was already on disk
+        elapsed = (self.last_fetch or 0) - self.started
+        return self.fetched / elapsed if self.fetched and elapsed > 0 else None
+
+    def start(self):
+        with self.cond:
+            for _ in range(min(PREFETCH_CONNECTIONS, len(self.pending)) - self.fetchers):
+                self.fetchers += 1
+                threading.Thread(target=self._fetch_loop, daemon=True).start()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def wait(self, timeout):
+        with self.cond: self.cond.wait(timeout)
+
+    def ready(self):
+        # Streamable spools start after start_bytes (PREFETCH_START_BYTES or the origin's) in order; MP4/MOV (index possibly at the end) and
+        # HLS need everything, verified once more before ffmpeg opens it
+        with self.cond:
+            if self.error or self.stopped: return True
+            if self.spooled and self.streamable is None and 0 in self.hashes:
+                with open(self.input_path, "rb") as f: self.streamable = f.read(8)[4:8] != b"ftyp"
+            if not self.complete:
+                if self.streamable and self.contiguous() >= self.start_bytes:
+                    self.input = "pipe:0"
+                    return True
+                return False
+        bad = [i for i in range(len(self.pieces)) if self.digest(i) != self.hashes.get(i)]
+        if bad:
+            self.refetch(bad)
+            return False
+        self.input = self.input_path
+        return True
+
+    def contiguous(self):
+        n = 0
+        while n in self.hashes: n += 1
+        return self.pieces[n - 1]["end"] + 1 if n else 0
+
+    def refetch(self, indexes):
+        with self.cond:
+            for i in indexes:
+                self.hashes.pop(i, None)
+                if i not in self.pending: self.pending.append(i)
+            self.pending.sort()
+        self.start()
+
+    def digest(self, i):
+        piece = self.pieces[i]
+        h = hashlib.sha256()
+        try:
+            with open(piece["path"], "rb") as f:
+                if piece["start"] is None:
+                    for block in iter(lambda: f.read(1024 * 1024), b""): h.update(block)
+                else:
+                    f.seek(piece["start"])
+                    h.update(f.read(piece["end"] - piece["start"] + 1))
+        except OSError: return None
+        return h.hexdigest()
+
+    def _fetch_loop(self):
+        while True:
+            with self.cond:
+                if self.stopped or self.error or not self.pending:
+                    self.fetchers -= 1
+                    return
+                i = self.pending.pop(0)
+            try: sha = self._fetch(self.pieces[i])
+            except FETCH_ERRORS as e:
+                with self.cond:
+                    self.error = self.error or f"{e}"
+                    self.fetchers -= 1
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                if sha is None: continue  # stopped
+                self.hashes[i] = sha
+                tmp = self.manifest_path + ".tmp"
+                with open(tmp, "w") as f: json.dump({"url": self.url, "pieces": len(self.pieces), "hashes": self.hashes}, f)
+                os.replace(tmp, self.manifest_path)
+                self.cond.notify_all()
+
+    def _fetch(self, piece):
+        ranged = piece["start"] is not None
+        for attempt in range(PREFETCH_RETRIES):
+            h, written = hashlib.sha256(), 0
+            try:
+                with http_open(piece["url"], piece["start"], piece["end"], referer=self.url) as r:
+                    if ranged:
+                        expected = piece["end"] - piece["start"] + 1
+                        if r.status != 206 or not r.headers.get("Content-Range", "").startswith(f"bytes {piece['start']}-{piece['end']}/"):
+                            raise ValueError("server ignored the byte range")
+                    else: expected = int(r.headers["Content-Length"]) if r.headers.get("Content-Length", "").isdigit() else None
+                    with open(piece["path"], "r+b" if ranged else "wb") as f:
+                        if ranged: f.seek(piece["start"])
+                        while block := r.read(UPLOAD_CHUNK):
+                            if self.stopped: return None
+                            if expected is not None and written + len(block) > expected: raise ValueError("server sent more than asked for")
+                            f.write(block)
+                            h.update(block)
+                            written += len(block)
+                if expected is not None and written != expected: raise ValueError(f"short read: {written} of {expected} bytes")
+                with self.cond:
+                    self.fetched += written
+                    self.last_fetch = time.time()
+                return h.hexdigest()
+            except FETCH_ERRORS:
+                with self.cond: self.retries += 1
+                if attempt == PREFETCH_RETRIES - 1 or self.stopped: raise
+                time.sleep(2 ** attempt)
+
+    def feed(self, pipe):
+        # Hands the spool to ffmpeg's stdin in order, each chunk checked against its hash first
+        try:
+            with open(self.input_path, "rb") as f:
+                for i, piece in enumerate(self.pieces):
+                    while True:
+                        with self.cond:
+                            while i not in self.hashes and not (self.stopped or self.error): self.cond.wait(1)
+                            if i not in self.hashes: return
+                            sha = self.hashes[i]
+                        f.seek(piece["start"])
+                        data = f.read(piece["end"] - piece["start"] + 1)
+                        if hashlib.sha256(data).hexdigest() == sha: break
+                        self.refetch([i])
+                    pipe.write(data)
+        except (BrokenPipeError, ValueError, OSError): pass  # ffmpeg is gone
+        finally:
+            try: pipe.close()
+            except OSError: pass
+
+# --- RESUME ---
+# A failed attempt that got somewhere keeps its output as staging/parts/partNNN.mkv and the job goes to
+# 'retrying' (RESUME_BACKOFF, doubling, RESUME_MAX_RETRIES times). The next attempt seeks the source to
+# where the last part ended (-ss, minus RESUME_MARGIN) and writes only the source streams into a new part.
+# Once a part reaches the end, a join attempt concatenates them losslessly (concat demuxer, each part cut
+# where the next one starts) and adds the subtitle and font. parts: [{file, start, end}], end None = last.
+def resume_output(staging):
+    os.makedirs(os.path.join(staging, "parts"), exist_ok=True)
+    return os.path.join(staging, "parts", "current.mkv")
+
+def media_start(path):
+    # First timestamp in a part; with -copyts -start_at_zero that is its position in the source
+    try:
+        res = subprocess.run([FFPROBE_BIN, '-v', 'error', '-show_entries', 'format=start_time', '-of', 'csv=p=0', path],
+                             capture_output=True, timeout=PROBE_TIMEOUT)
+        return float(res.stdout.decode().strip())
+    except (OSError, subprocess.TimeoutExpired, ValueError): return None
+
+def keep_part(job, parts, end):
+    # Moves the attempt's output into the parts folder -> its parts entry
+    spec = json.loads(job["spec"])
+    attempt = resume_output(spec["staging"]) if parts else os.path.join(DOWNLOAD_FOLDER, job["realname"])
+    name = f"part{len(parts):03d}.mkv"
+    path = os.path.join(spec["staging"], "parts", name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(attempt, path)
+    start = (media_start(path) if parts else None) or (parts[-1]["end"] if parts else 0.0)
+    return {"file": name, "start": start, "end": end}
+
+def write_concat_list(staging, parts):
+    path = os.path.join(staging, "parts", "concat.txt")
+    with open(path, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        for part, following in zip(parts, parts[1:] + [None]):
+            f.write(f"file '{part['file']}'\n")
+            if following: f.write(f"outpoint {following['start']:.6f}\n")
+    return path
+
+def schedule_retry(job, parts, tail, error):
+    # -> True when the job went back to 'retrying' instead of failing
+    spec = json.loads(job["spec"] or "{}")
+    if job["live"] or not spec.get("staging") or job["attempts"] >= RESUME_MAX_RETRIES: return False
+    joining = bool(parts) and parts[-1]["end"] is None
+    if not joining:
+        start = parts[-1]["end"] if parts else 0.0
+        reached = tail.out_time - RESUME_MARGIN
+        attempt = resume_output(spec["staging"]) if parts else os.path.join(DOWNLOAD_FOLDER, job["realname"])
+        if reached - start >= RESUME_MIN_PROGRESS and os.path.exists(attempt):
+            try: parts.append(keep_part(job, parts, reached))
+            except OSError as e: app.logger.warning("could not keep partial output of %s: %s", job["realname"], e)
+    delay = RESUME_BACKOFF * 2 ** job["attempts"]
+    group_update(job["realname"], state="retrying", retry_at=time.time() + delay, attempts=job["attempts"] + 1,
+               parts=json.dumps(parts) if parts else None, owner=None, pid=None, speed=None, eta=None,
+               error=f"{error}; retry {job['attempts'] + 1} of {RESUME_MAX_RETRIES}" + (f" resumes at {fmt_eta(parts[-1]['end'])}" if parts and not joining else ""))
+    try: os.remove(os.path.join(DOWNLOAD_FOLDER, job["realname"] + ".progress"))
+    except OSError: pass
+    return True
+
+# --- RETENTION ---
+# Finished outputs are evicted least-recently-downloaded first once they pass RETENTION_MAX_AGE, the
+# downloads/ total passes RETENTION_MAX_BYTES or free disk drops below MIN_FREE_BYTES. Active jobs are
+# never touched. The same sweep removes files nothing in the registry points at any more.
+def estimate_output_size(probe):
+    # A copy mux writes about as many bytes as the source has
+    if probe.get("size"): return probe["size"]
+    if probe.get("bit_rate") and probe.get("duration"): return int(probe["bit_rate"] * probe["duration"] / 8)
+    return None
+
+def estimate_spool_size(probe):
+    # A prefetched source is spooled whole into the job's staging dir before (or while) it is muxed
+    return estimate_output_size(probe) if PREFETCH_CONNECTIONS > 1 else None
+
+def free_disk_bytes():
+    # Free space minus what queued and running jobs are still expected to write: outputs and prefetch spools
+    pending = db().execute("SELECT COALESCE(SUM(MAX(COALESCE(expected_size - size, 0), 0) + MAX(COALESCE(spool_size - COALESCE(spooled, 0), 0), 0)), 0) "
+                           "FROM jobs WHERE state IN ('queued', 'retrying', 'processing')").fetchone()[0]
+    return shutil.disk_usage(DOWNLOAD_FOLDER).free - pending
+
+def has_room_for(probe, outputs=1):
+    return free_disk_bytes() - (estimate_output_size(probe) or 0) * outputs - (estimate_spool_size(probe) or 0) >= MIN_FREE_BYTES
+
+def claim_sweep():
+    # One sweep per GC_INTERVAL across all web workers
+    now = time.time()
+    return db().execute("INSERT INTO meta (key, value) VALUES ('swept_at', ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value "
+                        "WHERE CAST(value AS REAL) < ?", (str(now), now - GC_INTERVAL)).rowcount > 0
+
+def remove_untracked(path, removed, reason):
+    try:
+        if time.time() - os.path.getmtime(path) < GC_GRACE: return
+        if os.path.isdir(path): shutil.rmtree(path)
+        else: os.remove(path)
+        removed[reason] = removed.get(reason, 0) + 1
+    except OSError: pass
+
+def output_links(realname):
+    try: return os.stat(os.path.join(DOWNLOAD_FOLDER, realname)).st_nlink
+    except OSError: return 0
+
+def sweep_storage():
+    conn = db()
+    now = time.time()
+    removed = {}
+    # Low on disk: the result cache goes first (least recently used first). An output hardlinked into it
+    # frees nothing when deleted, so deleting outputs before their cache entries would empty downloads/ for nothing
+    for row in conn.execute("SELECT key FROM cache ORDER BY last_used").fetchall():
+        if shutil.disk_usage(DOWNLOAD_FOLDER).free >= MIN_FREE_BYTES: break
+        remove_cache_entry(row["key"])
+        removed["cache"] = removed.get("cache", 0) + 1
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM jobs").fetchone()[0]
+    for job in conn.execute("SELECT * FROM jobs WHERE state IN ('done', 'error') "
+                            "ORDER BY COALESCE(last_downloaded_at, finished_at, updated_at)").fetchall():
+        last_used = job["last_downloaded_at"] or job["finished_at"] or job["updated_at"]
+        if RETENTION_MAX_AGE and now - last_used > RETENTION_MAX_AGE: reason = "age"
+        elif RETENTION_MAX_BYTES and total > RETENTION_MAX_BYTES: reason = "budget"
+        elif shutil.disk_usage(DOWNLOAD_FOLDER).free < MIN_FREE_BYTES:
+            if output_links(job["realname"]) > 1: continue  # still linked from another job's output: deleting it frees nothing
+            reason = "disk"
+        else: break
+        # Skip it if the name was re-submitted since the SELECT
+        if conn.execute("DELETE FROM jobs WHERE id = ? AND updated_at = ?", (job["id"], job["updated_at"])).rowcount:
+            remove_job_files(job["realname"])
+            remove_job_inputs(job)
+            total -= job["size"]
+            removed[reason] = removed.get(reason, 0) + 1
+
+    # Logs and outputs of jobs that are gone
+    known = {r["realname"] for r in conn.execute("SELECT realname FROM jobs")}
+    for f in os.listdir(DOWNLOAD_FOLDER):
+        base = f.removesuffix(".log").removesuffix(".progress")
+        if base not in known: remove_untracked(os.path.join(DOWNLOAD_FOLDER, f), removed, "orphan")
+    # Staging dirs and legacy uploads/<uid>_* files no active job reads
+    in_use = set()
+    for row in conn.execute(f"SELECT spec FROM jobs WHERE state IN ({', '.join('?' * len(ACTIVE_STATES))})", ACTIVE_STATES):
+        spec = json.loads(row["spec"] or "{}")
+        in_use.update(filter(None, (spec.get("staging"), spec.get("sub_path"))))
+    for path in [os.path.join(STAGING_FOLDER, d) for d in os.listdir(STAGING_FOLDER)] + \
+                [os.path.join(UPLOAD_FOLDER, f) for f in os.listdir(UPLOAD_FOLDER) if os.path.isfile(os.path.join(UPLOAD_FOLDER, f))]:
+        if path not in in_use: remove_untracked(path, removed, "staging")
+    uploads = {r["id"] for r in conn.execute("SELECT id FROM uploads")}
+    for f in os.listdir(INCOMING_FOLDER):
+        if f not in uploads: remove_untracked(incoming_path(f), removed, "upload")
+    if RETENTION_MAX_AGE:
+        for row in conn.execute("SELECT hash FROM subtitles WHERE last_used < ?", (now - RETENTION_MAX_AGE,)).fetchall():
+            conn.execute("DELETE FROM subtitles WHERE hash = ?", (row["hash"],))
+            try: os.remove(os.path.join(SUB_CACHE_FOLDER, row["hash"] + ".ass"))
+            except OSError: pass
+            removed["sub_cache"] = removed.get("sub_cache", 0) + 1
+        for f in os.listdir(FONT_SUBSET_FOLDER):
+            path = os.path.join(FONT_SUBSET_FOLDER, f)
+            try:
+                if now - os.path.getmtime(path) > RETENTION_MAX_AGE:
+                    os.remove(path)
+                    removed["font_subset"] = removed.get("font_subset", 0) + 1
+            except OSError: pass
+
+    if removed:
+        write_metrics({("muxer_gc_removed_total", f'reason="{reason}"'): n for reason, n in removed.items()})
+        app.logger.info("storage sweep removed %s", removed)
+    return removed
+
+init_db()
+
 # --- UI CODE ---
 HTML_CODE = """
 <!DOCTYPE html>
@@ -84,7 +1946,22 @@ HTML_CODE = """
         .status-done { background: rgba(0, 255, 136, 0.1); color: #00ff88; }
         .status-run { background: rgba(0, 212, 255, 0.1); color: #00d4ff; }
         .status-err { background: rgba(255, 50, 50, 0.1); color: #ff3232; }
+        .status-queue { background: rgba(255, 187, 0, 0.1); color: #ffbb00; }
+        .flash { background: rgba(255, 187, 0, 0.1); border: 1px solid rgba(255, 187, 0, 0.3); color: #ffbb00; font-size: 12px; padding: 10px 14px; border-radius: 10px; margin-bottom: 15px; }
         .progress-bar { height: 4px; background: #333; border-radius: 2px; overflow: hidden; margin-top: 8px; }
+        .probe-status { font-size: 11px; color: #888; margin-top: 6px; min-height: 14px; }
+        .probe-status.ok { color: #00ff88; }
+        .probe-status.bad { color: #ff3232; }
+        .batch-mode { margin-top: 20px; }
+        .batch-mode summary { cursor: pointer; font-size: 13px; color: #b3b3b3; font-weight: 600; }
+        .track-row { display: flex; gap: 8px; align-items: center; margin-top: 8px; }
+        .track-row input[type="text"] { flex: 1; padding: 10px 12px; }
+        .track-default { display: flex; align-items: center; gap: 4px; margin: 0; font-weight: 400; white-space: nowrap; }
+        textarea { width: 100%; padding: 14px 16px; background-color: #212126; border: 1px solid #333; border-radius: 12px; color: #fff; font-size: 13px; outline: none; resize: vertical; font-family: monospace; }
+        .batch-group { background-color: #15151a; border: 1px solid #2a2a30; border-radius: 14px; padding: 12px; margin-bottom: 12px; }
+        .batch-group .progress-bar { margin: 0 0 12px; }
+        .batch-summary { font-size: 11px; color: #888; }
+        .progress-text { text-align: right; font-size: 11px; color: #888; }
         .progress-fill { height: 100%; background: linear-gradient(90deg, #00d4ff, #7b61ff); transition: width 0.5s; }
         .action-row { display: flex; gap: 8px; margin-top: 12px; }
         .btn-small { padding: 8px; border-radius: 8px; font-size: 12px; font-weight: 600; text-align: center; text-decoration: none; cursor: pointer; transition: 0.2s; border: none;}
@@ -100,25 +1977,215 @@ HTML_CODE = """
         function updateFileName(input, id) {
             document.getElementById(id).innerText = input.files[0] ? input.files[0].name : "Choose File...";
         }
+        function addTrack() {
+            const box = document.getElementById('extra-tracks');
+            const n = box.children.length + 1;
+            const row = document.createElement('div');
+            row.innerHTML = `<label>Subtitle Track ${n + 1} (.ASS, .SRT, .VTT)</label>
+                <div class="file-upload">
+                    <span class="file-name-display" id="extra-sub-${n}">Select Subtitle File</span>
+                    <span class="upload-icon">📂</span>
+                    <input type="file" name="extra_sub" accept=".ass,.ssa,.srt,.vtt" onchange="updateFileName(this, 'extra-sub-${n}')">
+                </div>
+                <div class="track-row">
+                    <input type="text" name="extra_lang" placeholder="Language (e.g. spa)">
+                    <input type="text" name="extra_title" placeholder="Title (e.g. Español)">
+                    <label class="track-default"><input type="radio" name="default_track" value="${n}"> default</label>
+                </div>`;
+            box.appendChild(row);
+        }
         function copyLink(filename) {
-            const link = window.location.origin + "/download/" + filename;
+            const link = window.location.origin + "/download/" + encodeURIComponent(filename);
             navigator.clipboard.writeText(link).then(() => alert("✅ Link Copied!\\n" + link)).catch(() => prompt("Copy this:", link));
         }
+
+        // --- RESUMABLE UPLOADS ---
+        const UPLOAD_CHUNK = 1024 * 1024;
+        const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+        async function resumableUpload(file, onProgress) {
+            const created = await fetch('/uploads', {
+                method: 'POST', headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ filename: file.name, size: file.size })
+            }).then(r => r.ok ? r.json() : r.json().then(body => { throw new Error(body.error); }));
+            let offset = 0, failures = 0;
+            while (offset < file.size) {
+                try {
+                    const r = await fetch('/uploads/' + created.id, {
+                        method: 'PATCH',
+                        headers: { 'Upload-Offset': String(offset), 'Content-Type': 'application/offset+octet-stream' },
+                        body: file.slice(offset, offset + UPLOAD_CHUNK)
+                    });
+                    if (!r.ok) throw new Error('HTTP ' + r.status);
+                    offset = Number(r.headers.get('Upload-Offset'));
+                    failures = 0;
+                    onProgress(offset / file.size);
+                } catch (err) {
+                    if (++failures > 8) throw err;
+                    await sleep(1000 * failures);
+                    // Ask the server how much it kept and carry on from there
+                    const head = await fetch('/uploads/' + created.id, { method: 'HEAD' }).catch(() => null);
+                    if (head && head.ok) offset = Number(head.headers.get('Upload-Offset'));
+                }
+            }
+            return created.id;
+        }
+        function submitResumable(form) {
+            if (!window.fetch || !window.Blob) return true;
+            const inputs = Array.from(form.querySelectorAll('input[type=file][data-resumable]')).filter(i => i.files.length);
+            if (!inputs.length) return true;
+            const button = form.querySelector('button[type=submit]');
+            const label = button.textContent;
+            button.disabled = true;
+            (async () => {
+                try {
+                    for (const input of inputs) {
+                        const file = input.files[0];
+                        const id = await resumableUpload(file, p => { button.textContent = 'Uploading ' + file.name + ' ' + Math.floor(p * 100) + '%'; });
+                        const hidden = document.createElement('input');
+                        hidden.type = 'hidden';
+                        hidden.name = input.dataset.resumable;
+                        hidden.value = id;
+                        form.appendChild(hidden);
+                        input.disabled = true;  // already on the server, don't send it again
+                    }
+                    form.submit();
+                } catch (err) {
+                    inputs.forEach(i => { i.disabled = false; });
+                    form.querySelectorAll('input[type=hidden][name$=_upload]').forEach(h => h.remove());
+                    button.disabled = false;
+                    button.textContent = label;
+                    alert('Upload failed: ' + err.message);
+                }
+            })();
+            return false;
+        }
+
+        // --- SOURCE PROBE ---
+        let probeTimer = null;
+        function probeLater(url) {
+            clearTimeout(probeTimer);
+            const box = document.getElementById('probe-status');
+            box.className = 'probe-status';
+            box.textContent = '';
+            if (!/^https?:/.test(url.trim())) return;
+            probeTimer = setTimeout(() => {
+                box.textContent = 'Checking source...';
+                fetch('/probe?url=' + encodeURIComponent(url.trim())).then(r => r.json()).then(info => {
+                    if (!info.ok) { box.className = 'probe-status bad'; box.textContent = '✖ ' + info.error; return; }
+                    const count = type => info.streams.filter(s => s.type === type).length;
+                    const mins = info.duration ? Math.floor(info.duration / 60) + ':' + String(Math.floor(info.duration % 60)).padStart(2, '0') + ' · ' : '';
+                    box.className = 'probe-status ok';
+                    box.textContent = '✔ ' + mins + (info.container || '') + ' · ' + count('video') + ' video, ' + count('audio') + ' audio';
+                }).catch(() => { box.textContent = ''; });
+            }, 600);
+        }
+
+        // --- LIVE STATUS (SSE) ---
+        const STATUS_CLASS = { done: 'status-done', processing: 'status-run', queued: 'status-queue', retrying: 'status-queue' };
+        function esc(value) {
+            const d = document.createElement('div');
+            d.textContent = value == null ? '' : String(value);
+            return d.innerHTML.replace(/"/g, '&quot;');
+        }
+        function progressText(job) {
+            return (job.speed ? job.speed.toFixed(1) + 'x' + (job.eta ? ' · ETA ' + job.eta : '') + ' · ' : '') + job.percent + '%';
+        }
+        function jobCard(job) {
+            const link = encodeURIComponent(job.realname);
+            const cancel = '<div class="action-row"><a href="/delete/' + link + '" class="btn-small btn-del" style="width: 100%">✖ Cancel</a></div>';
+            const liveRow = '<div class="action-row"><a href="/download/' + link + '" class="btn-small btn-dl">⬇ Download (live)</a><a href="/delete/' + link + '" class="btn-small btn-del">✖</a></div>';
+            let html = '<div class="file-card" data-realname="' + esc(job.realname) + '" data-status="' + esc(job.status)
+                + '" data-percent="' + (job.status === 'done' ? 100 : job.percent) + '">'
+                + '<div class="file-header"><span class="fname">' + esc(job.name) + '</span>'
+                + '<span class="status-badge ' + (STATUS_CLASS[job.status] || 'status-err') + '">' + esc(job.status) + '</span></div>';
+            if (job.status === 'processing') {
+                html += '<div class="progress-bar"><div class="progress-fill" style="width: ' + job.percent + '%;"></div></div>'
+                    + '<div class="progress-text">' + esc(progressText(job)) + '</div>' + (job.live ? liveRow : cancel);
+            } else if (job.status === 'queued') {
+                html += '<div class="progress-text">#' + job.position + ' in queue</div>' + cancel;
+            } else if (job.status === 'retrying') {
+                html += '<div class="progress-bar"><div class="progress-fill" style="width: ' + job.percent + '%;"></div></div>'
+                    + '<div class="progress-text">' + esc(job.error) + '</div>' + cancel;
+            } else if (job.status === 'done') {
+                html += '<div class="action-row"><a href="/download/' + link + '" class="btn-small btn-dl">⬇ Download</a>'
+                    + '<button onclick="copyLink(this.closest(\\'.file-card\\').dataset.realname)" class="btn-small btn-copy">📋 Copy Link</button>'
+                    + '<a href="/delete/' + link + '" class="btn-small btn-del">🗑</a></div>';
+            } else if (job.status === 'error') {
+                if (job.error) html += '<div class="progress-text" style="color: #ff3232; text-align: left;">' + esc(job.error) + '</div>';
+                html += '<div class="action-row"><a href="/delete/' + link + '" class="btn-small btn-del" style="width: 100%">🗑 Remove</a></div>';
+            }
+            return html + '</div>';
+        }
+        function allCards() {
+            return Array.from(document.querySelectorAll('#batches .file-card, #jobs .file-card'));
+        }
+        function findCard(realname) {
+            return allCards().find(c => c.dataset.realname === realname);
+        }
+        function batchGroup(job) {
+            let group = Array.from(document.querySelectorAll('#batches .batch-group')).find(g => g.dataset.batch === job.batch);
+            if (group) return group;
+            const holder = document.createElement('div');
+            holder.innerHTML = '<div class="batch-group" data-batch="' + esc(job.batch) + '"><div class="file-header">'
+                + '<span class="fname">📦 ' + esc(job.batch_name) + '</span><span class="batch-summary"></span></div>'
+                + '<div class="progress-bar"><div class="progress-fill batch-fill" style="width: 0%;"></div></div><div class="batch-jobs"></div></div>';
+            group = holder.firstChild;
+            document.getElementById('batches').appendChild(group);
+            return group;
+        }
+        function updateBatch(group) {
+            const cards = Array.from(group.querySelectorAll('.file-card'));
+            if (!cards.length) { group.remove(); return; }
+            const done = cards.filter(c => c.dataset.status === 'done').length;
+            const percent = Math.floor(cards.reduce((sum, c) => sum + Number(c.dataset.percent || 0), 0) / cards.length);
+            group.querySelector('.batch-summary').textContent = done + '/' + cards.length + ' done';
+            group.querySelector('.batch-fill').style.width = percent + '%';
+        }
+        function applyJob(job) {
+            const card = findCard(job.realname);
+            const group = job.batch ? batchGroup(job) : null;
+            if (card && card.dataset.status === 'processing' && job.status === 'processing') {
+                card.dataset.percent = job.percent;
+                card.querySelector('.progress-fill').style.width = job.percent + '%';
+                card.querySelector('.progress-text').textContent = progressText(job);
+            } else {
+                const holder = document.createElement('div');
+                holder.innerHTML = jobCard(job);
+                const fresh = holder.firstChild;
+                if (card) card.replaceWith(fresh);
+                else {
+                    const list = group ? group.querySelector('.batch-jobs') : document.getElementById('jobs');
+                    const after = Array.from(list.querySelectorAll('.file-card')).find(c => c.dataset.realname > job.realname);
+                    list.insertBefore(fresh, after || null);
+                    const empty = document.getElementById('no-jobs');
+                    if (empty) empty.remove();
+                }
+            }
+            if (group) updateBatch(group);
+        }
+        function removeJob(realname) {
+            const card = findCard(realname);
+            if (!card) return;
+            const group = card.closest('.batch-group');
+            card.remove();
+            if (group) updateBatch(group);
+        }
+        document.addEventListener('DOMContentLoaded', function() {
+            if (!window.EventSource) return;
+            const stream = new EventSource('/api/jobs/stream');
+            stream.addEventListener('snapshot', e => {
+                const jobs = JSON.parse(e.data);
+                const names = new Set(jobs.map(j => j.realname));
+                allCards().forEach(c => { if (!names.has(c.dataset.realname)) removeJob(c.dataset.realname); });
+                jobs.forEach(applyJob);
+            });
+            stream.addEventListener('job', e => applyJob(JSON.parse(e.data)));
+            stream.addEventListener('remove', e => removeJob(JSON.parse(e.data)));
+        });
     </script>
 </head>
 <body>
-    <div class="card">
-        <h1 class="title">AD Web Muxer !!</h1>
-        <form action="/start" method="POST" enctype="multipart/form-data">
-            <label>Video URL (M3U8)</label>
-            <input type="text" name="url" placeholder="Paste direct video link here..." required>
-            <label>Subtitle File (.ASS)</label>
-            <div class="file-upload">
-                <span class="file-name-display" id="sub-name">Select .ASS File</span>
-                <span class="upload-icon">📂</span>
-                <input type="file" name="sub" accept=".ass" required onchange="updateFileName(this, 'sub-name')">
-            </div>
-            
+{% macro font_fields(name_id) %}
             <label>Font (Optional)</label>
             {% if saved_fonts %}
             <select name="saved_font" style="margin-bottom: 8px;">
@@ -129,32 +2196,37 @@ HTML_CODE = """
             </select>
             {% endif %}
             <div class="file-upload">
-                <span class="file-name-display" id="font-name">Upload New Font (.TTF)</span>
+                <span class="file-name-display" id="{{ name_id }}">Upload New Font (.TTF)</span>
                 <span class="upload-icon">🔤</span>
-                <input type="file" name="font" accept=".ttf,.otf" onchange="updateFileName(this, 'font-name')">
+                <input type="file" name="font" accept=".ttf,.otf" data-resumable="font_upload" onchange="updateFileName(this, '{{ name_id }}')">
             </div>
-
-            <label>Output Filename</label>
-            <input type="text" name="fname" placeholder="e.g. Episode 01" required>
-            <button type="submit" class="btn-process">START MUXING 🚀</button>
-        </form>
-        <div class="footer">Powered by YukiSub</div>
-    </div>
-
-    <div class="recent-section">
-        <div class="section-header">
-            <span class="section-title">Recent Activity</span>
-            <button onclick="location.reload()" class="refresh-btn">🔄 Refresh</button>
-        </div>
-        {% for file in files %}
-        <div class="file-card">
+            {% if can_subset %}
+            <label style="display: flex; align-items: center; gap: 8px; font-weight: 400; margin-top: 6px;"><input type="checkbox" name="subset_font" checked> Only attach the glyphs the subtitles use</label>
+            {% endif %}
+{% endmacro %}
+{% macro job_card(file) %}
+        <div class="file-card" data-realname="{{ file.realname }}" data-status="{{ file.status }}" data-percent="{{ 100 if file.status == 'done' else file.percent }}">
             <div class="file-header">
                 <span class="fname">{{ file.name }}</span>
-                <span class="status-badge {{ 'status-done' if file.status == 'done' else 'status-run' if file.status == 'processing' else 'status-err' }}">{{ file.status }}</span>
+                <span class="status-badge {{ 'status-done' if file.status == 'done' else 'status-run' if file.status == 'processing' else 'status-queue' if file.status in ('queued', 'retrying') else 'status-err' }}">{{ file.status }}</span>
             </div>
             {% if file.status == 'processing' %}
                 <div class="progress-bar"><div class="progress-fill" style="width: {{ file.percent }}%;"></div></div>
-                <div style="text-align: right; font-size: 11px; color: #888;">{{ file.percent }}%</div>
+                <div class="progress-text">{% if file.speed %}{{ '%.1f'|format(file.speed) }}x{% if file.eta %} · ETA {{ file.eta }}{% endif %} · {% endif %}{{ file.percent }}%</div>
+                {% if file.live %}
+                <div class="action-row"><a href="/download/{{ file.realname }}" class="btn-small btn-dl">⬇ Download (live)</a><a href="/delete/{{ file.realname }}" class="btn-small btn-del">✖</a></div>
+                {% else %}
+                <div class="action-row"><a href="/delete/{{ file.realname }}" class="btn-small btn-del" style="width: 100%">✖ Cancel</a></div>
+                {% endif %}
+            {% endif %}
+            {% if file.status == 'queued' %}
+                <div class="progress-text">#{{ file.position }} in queue</div>
+                <div class="action-row"><a href="/delete/{{ file.realname }}" class="btn-small btn-del" style="width: 100%">✖ Cancel</a></div>
+            {% endif %}
+            {% if file.status == 'retrying' %}
+                <div class="progress-bar"><div class="progress-fill" style="width: {{ file.percent }}%;"></div></div>
+                <div class="progress-text">{{ file.error }}</div>
+                <div class="action-row"><a href="/delete/{{ file.realname }}" class="btn-small btn-del" style="width: 100%">✖ Cancel</a></div>
             {% endif %}
             {% if file.status == 'done' %}
             <div class="action-row">
@@ -164,99 +2236,682 @@ HTML_CODE = """
             </div>
             {% endif %}
             {% if file.status == 'error' %}
+             {% if file.error %}<div class="progress-text" style="color: #ff3232; text-align: left;">{{ file.error }}</div>{% endif %}
              <div class="action-row"><a href="/delete/{{ file.realname }}" class="btn-small btn-del" style="width: 100%">🗑 Remove</a></div>
             {% endif %}
         </div>
+{% endmacro %}
+    <div class="card">
+        <h1 class="title">AD Web Muxer !!</h1>
+        {% for message in get_flashed_messages() %}
+        <div class="flash">{{ message }}</div>
+        {% endfor %}
+        <form action="/start" method="POST" enctype="multipart/form-data" onsubmit="return submitResumable(this)">
+            <label>Video URL (M3U8)</label>
+            <input type="text" name="url" placeholder="Paste direct video link here..." required oninput="probeLater(this.value)">
+            <div id="probe-status" class="probe-status"></div>
+            <label>Subtitle File (.ASS, .SRT, .VTT)</label>
+            <div class="file-upload">
+                <span class="file-name-display" id="sub-name">Select Subtitle File</span>
+                <span class="upload-icon">📂</span>
+                <input type="file" name="sub" accept=".ass,.ssa,.srt,.vtt" required data-resumable="sub_upload" onchange="updateFileName(this, 'sub-name')">
+            </div>
+            
+            {{ font_fields('font-name') }}
+
+            <details class="batch-mode">
+                <summary>🎞 More subtitle tracks</summary>
+                <label>Main Subtitle Track</label>
+                <div class="track-row">
+                    <input type="text" name="sub_lang" placeholder="Language (e.g. eng)">
+                    <input type="text" name="sub_title" placeholder="Title (e.g. English)">
+                    <label class="track-default"><input type="radio" name="default_track" value="0" checked> default</label>
+                </div>
+                <div id="extra-tracks"></div>
+                <button type="button" class="refresh-btn" style="margin-top: 10px;" onclick="addTrack()">+ Add subtitle track</button>
+                <label>Extra Fonts (Optional)</label>
+                <div class="file-upload">
+                    <span class="file-name-display" id="extra-font-name">Attach more fonts (.TTF)</span>
+                    <span class="upload-icon">🔤</span>
+                    <input type="file" name="extra_font" accept=".ttf,.otf" multiple onchange="updateFileName(this, 'extra-font-name')">
+                </div>
+                <label>Output</label>
+                <select name="track_mode">
+                    <option value="tracks">One MKV with every subtitle track</option>
+                    <option value="variants">One MKV per subtitle track</option>
+                </select>
+            </details>
+
+            <label>Output Filename</label>
+            <input type="text" name="fname" placeholder="e.g. Episode 01" required>
+            <label style="display: flex; align-items: center; gap: 8px; font-weight: 400;"><input type="checkbox" name="low_priority"> Low priority (let other jobs go first)</label>
+            <label style="display: flex; align-items: center; gap: 8px; font-weight: 400; margin-top: 6px;"><input type="checkbox" name="live"> Live download (start downloading while muxing)</label>
+            <button type="submit" class="btn-process">START MUXING 🚀</button>
+        </form>
+        <details class="batch-mode">
+            <summary>📦 Batch mode (whole season)</summary>
+            <form action="/start_batch" method="POST" enctype="multipart/form-data" onsubmit="return submitResumable(this)">
+                <label>Video URLs (one per line, in episode order)</label>
+                <textarea name="urls" rows="5" placeholder="https://.../ep01.m3u8&#10;https://.../ep02.m3u8" required></textarea>
+                <label>Subtitle Files (.ASS/.SRT/.VTT files or one .ZIP, matched by filename order)</label>
+                <div class="file-upload">
+                    <span class="file-name-display" id="subs-name">Select subtitle files or a .ZIP</span>
+                    <span class="upload-icon">📂</span>
+                    <input type="file" name="subs" accept=".ass,.ssa,.srt,.vtt,.zip" multiple required onchange="updateFileName(this, 'subs-name')">
+                </div>
+                {{ font_fields('batch-font-name') }}
+                <label>Filename Pattern</label>
+                <input type="text" name="pattern" value="Episode {n:02}" required>
+                <label>First Episode Number</label>
+                <input type="text" name="first" value="1" inputmode="numeric">
+                <button type="submit" class="btn-process">QUEUE BATCH 📦</button>
+            </form>
+        </details>
+        <div class="footer">Powered by YukiSub</div>
+    </div>
+
+    <div class="recent-section">
+        <div class="section-header">
+            <span class="section-title">Recent Activity</span>
+            <button onclick="location.reload()" class="refresh-btn">🔄 Refresh</button>
+        </div>
+        <div id="batches">
+        {% for batch in batches %}
+        <div class="batch-group" data-batch="{{ batch.id }}">
+            <div class="file-header">
+                <span class="fname">📦 {{ batch.name }}</span>
+                <span class="batch-summary">{{ batch.done }}/{{ batch.total }} done</span>
+            </div>
+            <div class="progress-bar"><div class="progress-fill batch-fill" style="width: {{ batch.percent }}%;"></div></div>
+            <div class="batch-jobs">
+            {% for file in batch.jobs %}
+            {{ job_card(file) }}
+            {% endfor %}
+            </div>
+        </div>
+        {% endfor %}
+        </div>
+        <div id="jobs">
+        {% for file in files %}
+        {{ job_card(file) }}
         {% else %}
-        <div style="text-align: center; color: #555; font-size: 12px; margin-top: 20px;">No files yet. Start muxing above!</div>
+        <div id="no-jobs" style="text-align: center; color: #555; font-size: 12px; margin-top: 20px;">No files yet. Start muxing above!</div>
         {% endfor %}
+        </div>
     </div>
 </body>
 </html>
 """
 
+ADMIN_ORIGINS_HTML = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>Origin profiles</title>
+    <style>
+        * { box-sizing: border-box; font-family: sans-serif; }
+        body { background-color: #0d0d10; color: #eee; padding: 20px; font-size: 13px; }
+        h1 { font-size: 20px; margin-bottom: 6px; }
+        .hint { color: #888; margin-bottom: 16px; }
+        .flash { background: rgba(255, 187, 0, 0.1); border: 1px solid rgba(255, 187, 0, 0.3); color: #ffbb00; padding: 8px 12px; border-radius: 8px; margin-bottom: 12px; }
+        table { border-collapse: collapse; width: 100%; margin-bottom: 24px; }
+        th, td { border-bottom: 1px solid #25252b; padding: 6px 8px; text-align: left; vertical-align: top; }
+        th { color: #888; font-weight: 600; }
+        code { color: #00d4ff; }
+        input[type="text"], input[type="password"] { width: 100px; padding: 4px 6px; background-color: #212126; border: 1px solid #333; border-radius: 6px; color: #fff; }
+        button { padding: 4px 10px; border: none; border-radius: 6px; background: #7b61ff; color: #fff; cursor: pointer; }
+        .pins { display: flex; flex-wrap: wrap; gap: 6px; align-items: center; }
+        .pins label { color: #888; }
+    </style>
+</head>
+<body>
+    <h1>Origin profiles</h1>
+    <p class="hint">Learned from past jobs and probes; a host needs {{ min_samples }} samples before its settings are used.
+        Pin a value to override it (a number, K/M/G allowed, or <code>default</code> for ffmpeg's own); leave it empty to go back to learning.
+        Durations are in microseconds, sizes in bytes.</p>
+    {% for message in get_flashed_messages() %}<div class="flash">{{ message }}</div>{% endfor %}
+    {% if not signed_in %}
+    <form method="post" class="pins">
+        <label>Admin token <input type="password" name="token"></label>
+        <button type="submit">Sign in</button>
+    </form>
+    {% else %}
+    <table>
+        <tr><th>Host</th><th>Jobs</th><th>Failed</th><th>Probes</th><th>Open s</th><th>Probe s</th><th>Reconnects</th>
+            <th>Throughput</th><th>Layout</th><th>In effect</th><th>Pins</th></tr>
+        {% for o in profiles %}
+        <tr>
+            <td>{{ o.host }}</td><td>{{ o.jobs }}</td><td>{{ o.failures }}</td><td>{{ o.probes }}</td>
+            <td>{{ '%.2f'|format(o.open_seconds) if o.open_seconds is not none else '-' }}</td>
+            <td>{{ '%.2f'|format(o.probe_seconds) if o.probe_seconds is not none else '-' }}</td>
+            <td>{{ '%.2f'|format(o.reconnects) if o.reconnects is not none else '-' }}</td>
+            <td>{{ '%.1f MB/s'|format(o.throughput / 1048576) if o.throughput else '-' }}</td>
+            <td><code>{{ o.layout or '-' }}</code><br>{{ o.layout_runs }} in a row, {{ o.layout_changes }} changes</td>
+            <td>{% for k, v in o.settings.items() %}<code>{{ k }}={{ v }}</code>{% if k in o.pinned %} (pinned){% endif %}<br>{% else %}ffmpeg defaults{% endfor %}</td>
+            <td>
+                <form method="post" class="pins">
+                    <input type="hidden" name="csrf" value="{{ csrf }}"><input type="hidden" name="host" value="{{ o.host }}">
+                    {% for name in names %}
+                    <label>{{ name }} <input type="text" name="{{ name }}"
+                        value="{{ ('default' if o.pinned[name] is none else o.pinned[name]) if name in o.pinned else '' }}"
+                        placeholder="{{ o.learned.get(name, 'default') }}"></label>
+                    {% endfor %}
+                    <button type="submit">Save</button>
+                </form>
+            </td>
+        </tr>
+        {% else %}
+        <tr><td colspan="11">No origins seen yet.</td></tr>
+        {% endfor %}
+    </table>
+    <form method="post" class="pins">
+        <input type="hidden" name="csrf" value="{{ csrf }}">
+        <label>Pin a new host <input type="text" name="host" placeholder="cdn.example.com"></label>
+        {% for name in names %}<label>{{ name }} <input type="text" name="{{ name }}" placeholder="default"></label>{% endfor %}
+        <button type="submit">Save</button>
+    </form>
+    {% endif %}
+</body>
+</html>
+"""
+
+# --- PAGE CACHE ---
+# The home page is compiled once and rendered at most once per change to what it shows: the user's
+# user_state version (bumped by triggers on every job and font change) plus the queue positions on their
+# queued cards, which other users' jobs move. That key is also the ETag, so an unchanged poll is a 304.
+HOME_TEMPLATE = app.jinja_env.from_string(HTML_CODE)
+TEMPLATE_HASH = hashlib.sha256(HTML_CODE.encode()).hexdigest()[:12]
+ADMIN_ORIGINS_TEMPLATE = app.jinja_env.from_string(ADMIN_ORIGINS_HTML)
+_page_cache = OrderedDict()  # uid -> (etag, {encoding: body})
+_page_cache_lock = threading.Lock()
+
+def page_state(uid):
+    # -> (etag, last modified) for what the home page and /api/jobs show this user
+    row = db().execute("SELECT version, updated_at FROM user_state WHERE uid = ?", (uid,)).fetchone()
+    version, updated_at = (row["version"], row["updated_at"]) if row else (0, None)
+    queued = db().execute("SELECT id, priority FROM jobs WHERE uid = ? AND state = 'queued' ORDER BY id", (uid,)).fetchall()
+    positions = ",".join(str(queue_position(job)) for job in queued)
+    return hashlib.sha256(f"{TEMPLATE_HASH}:{uid}:{version}:{positions}".encode()).hexdigest()[:24], updated_at
+
+def not_modified(etag, last_modified):
+    if request.if_none_match: return request.if_none_match.contains_weak(etag)
+    return bool(last_modified and request.if_modified_since and int(last_modified) <= request.if_modified_since.timestamp())
+
+def conditional(response, etag, last_modified):
+    # Browsers revalidate on every load; the validators make that a 304 while nothing changed
+    response.set_etag(etag, weak=True)
+    if last_modified: response.last_modified = int(last_modified)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.update(("Cookie", "Accept-Encoding"))
+    return response
+
+def cached_page(uid, etag, render):
+    # -> (body, Content-Encoding or None); renders once per etag, compresses once per encoding
+    with _page_cache_lock:
+        entry = _page_cache.get(uid)
+        if entry and entry[0] == etag: _page_cache.move_to_end(uid)
+        else: entry = None
+    if entry is None:
+        entry = (etag, {None: render().encode("utf-8")})
+        with _page_cache_lock:
+            _page_cache[uid] = entry
+            while len(_page_cache) > PAGE_CACHE_SIZE: _page_cache.popitem(last=False)
+    bodies = entry[1]
+    encoding = response_encoding()
+    if encoding and encoding not in bodies: bodies[encoding] = compress(bodies[None], encoding)
+    return bodies[encoding], encoding
+
 # --- ROUTES ---
+def render_home(uid):
+    saved_fonts_list = user_fonts(uid)
+
+    files_data, batches = [], {}
+    for job in map(job_view, jobs_for_uid(uid)):
+        if not job["batch"]:
+            files_data.append(job)
+            continue
+        group = batches.setdefault(job["batch"], {"id": job["batch"], "name": job["batch_name"], "jobs": []})
+        group["jobs"].append(job)
+    for group in batches.values():
+        group["total"] = len(group["jobs"])
+        group["done"] = sum(j["status"] == "done" for j in group["jobs"])
+        group["percent"] = sum(100 if j["status"] == "done" else j["percent"] for j in group["jobs"]) // group["total"]
+    return render_template(HOME_TEMPLATE, files=files_data, batches=list(batches.values()), saved_fonts=saved_fonts_list,
+                           can_subset=font_subset is not None)
+
 @app.route('/')
 def home():
     uid = get_uid()
-    files_data = []
-    saved_fonts_list = []
-    if os.path.exists(FONT_FOLDER):
-        saved_fonts_list = [f.replace(f"{uid}_", "") for f in sorted(os.listdir(FONT_FOLDER)) if f.startswith(uid)]
-
-    if os.path.exists(DOWNLOAD_FOLDER):
-        for f in sorted(os.listdir(DOWNLOAD_FOLDER)):
-            if f.startswith(uid) and f.endswith(".mkv"):
-                status = "done"
-                log_file = os.path.join(DOWNLOAD_FOLDER, f + ".log")
-                percent = 0
-                if os.path.exists(log_file):
-                    try:
-                        with open(log_file, 'r', encoding='utf-8', errors='ignore') as lf:
-                            c = lf.read()
-                            percent = calculate_progress(c)
-                            if "Error" in c or "Invalid data" in c: status = "error"
-                            elif "muxing overhead" in c or "LSIZE" in c: status = "done"; percent = 100
-                            else: status = "processing"
-                    except: status = "processing"
-                files_data.append({"name": f.replace(f"{uid}_", "").replace(".mkv", ""), "realname": f, "status": status, "percent": percent})
-    
-    return render_template_string(HTML_CODE, files=files_data, saved_fonts=saved_fonts_list)
+    ensure_scheduler()
+    if session.get("_flashes"):
+        # One-off messages: render fresh and never cache or revalidate this copy
+        response = Response(render_home(uid), mimetype="text/html")
+        response.headers["Cache-Control"] = "no-store"
+        return response
+    etag, last_modified = page_state(uid)
+    if not_modified(etag, last_modified): return conditional(Response(status=304), etag, last_modified)
+    body, encoding = cached_page(uid, etag, lambda: render_home(uid))
+    response = Response(body, mimetype="text/html")
+    if encoding: response.headers["Content-Encoding"] = encoding
+    return conditional(response, etag, last_modified)
 
 @app.route('/start', methods=['POST'])
 def start_mux():
     uid = get_uid()
     url = request.form.get('url')
     fname = request.form.get('fname').strip()
-    
+    realname = f"{uid}_{fname}.mkv"
+    existing = job_get(realname)
+    if existing and existing["state"] in ACTIVE_STATES:
+        flash(f"'{fname}' is already {existing['state']}.")
+        return redirect(url_for('home'))
+    probe = probe_source(url)
+    if not probe["ok"]:
+        flash(f"✖ Source rejected: {probe['error']}")
+        return redirect(url_for('home'))
+
+    # One staging directory per job so queued jobs never read each other's upload
+    staging = new_staging_dir()
+    sub_path = os.path.join(staging, "sub.ass")
     sub_file = request.files.get('sub')
-    sub_path = os.path.join(UPLOAD_FOLDER, f"{uid}_sub.ass")
-    sub_file.save(sub_path)
-    
-    final_font_path = None
+    if request.form.get('sub_upload'):
+        if not take_upload(uid, request.form['sub_upload'], sub_path): sub_path = None
+    elif sub_file and sub_file.filename:
+        sub_file.save(sub_path)
+    else: sub_path = None
+    if not sub_path:
+        shutil.rmtree(staging, ignore_errors=True)
+        flash("✖ The subtitle upload is missing or incomplete.")
+        return redirect(url_for('home'))
+
+    tracks, default_track = form_tracks(staging, sub_path)
+    ingested = [ingest_subtitle(track["sub_path"]) for track in tracks]
+    bad = next((i for i, info in enumerate(ingested) if not info["ok"]), None)
+    names = variant_names(fname, tracks) if request.form.get('track_mode') == 'variants' and len(tracks) > 1 else [fname]
+    busy = [n for n in names if (j := job_get(f"{uid}_{n}.mkv")) and j["state"] in ACTIVE_STATES]
+    refused = f"✖ Subtitle{f' track {bad + 1}' if len(tracks) > 1 else ''} rejected: {ingested[bad]['error']}" if bad is not None else None
+    if not refused and busy: refused = f"✖ Already running: {', '.join(busy)}"
+    if not refused and not has_room_for(probe, len(names)):
+        refused = "✖ The server is short on disk space right now, please try again later."
+    if refused:
+        shutil.rmtree(staging, ignore_errors=True)
+        flash(refused)
+        return redirect(url_for('home'))
+
+    font_path, font_hash, font_name = resolve_font(uid)
+    live = 1 if request.form.get('live') else 0
+    spec = {"url": url, "staging": staging, "sub_path": sub_path, "font_path": font_path, "font_hash": font_hash, "font_name": font_name,
+            "subset": bool(font_subset and request.form.get('subset_font'))}
+    if len(tracks) > 1 or tracks[0]["language"] or tracks[0]["title"]: spec.update(tracks=tracks, default_track=default_track)
+    fonts = [save_font_upload(uid, f) for f in request.files.getlist('extra_font') if f and f.filename.lower().endswith(FONT_EXTENSIONS)]
+    fonts = [{"path": path, "hash": font_hash, "name": name} for name, font_hash, path in fonts]
+    # Saved fonts the scripts name in their styles or \fn overrides come along automatically
+    picked = referenced_fonts(uid, set().union(*(info["fonts"] for info in ingested)), {font_hash, *(f["hash"] for f in fonts)})
+    if fonts or picked: spec["fonts"] = fonts + picked
+    if picked: flash(f"🔤 Also attached your saved fonts the subtitles use: {', '.join(f['name'] for f in picked)}")
+    for i, info in enumerate(ingested):
+        for warning in info["warnings"]: flash(f"⚠ Subtitle{f' track {i + 1}' if len(tracks) > 1 else ''}: {warning}")
+    if len(names) > 1: spec["outputs"] = [f"{uid}_{n}.mkv" for n in names]
+    if submit_job(uid, names[0], spec, probe, priority=-1 if request.form.get('low_priority') else 0, live=live) == "cached":
+        flash(f"♻ '{fname}' was ready instantly from an identical earlier job.")
+    return redirect(url_for('home'))
+
+LANGUAGE_RE = re.compile(r"[A-Za-z]{2,3}(-[A-Za-z0-9]{1,8})*")
+
+def form_tracks(staging, sub_path):
+    # The main subtitle plus the form's extra tracks -> ([{sub_path, language, title}], index of the default track)
+    rows = [(sub_path, request.form.get('sub_lang'), request.form.get('sub_title'))]
+    chosen, default = request.form.get('default_track') or "0", 0
+    extra = zip(request.files.getlist('extra_sub'), request.form.getlist('extra_lang'), request.form.getlist('extra_title'))
+    for n, (sub_file, language, title) in enumerate(extra, 1):
+        if not sub_file.filename or not sub_file.filename.lower().endswith(SUB_EXTENSIONS): continue
+        path = os.path.join(staging, f"sub{n}.ass")
+        sub_file.save(path)
+        if chosen == str(n): default = len(rows)
+        rows.append((path, language, title))
+    tracks = []
+    for path, language, title in rows:
+        language, title = (language or "").strip(), (title or "").strip()[:100]
+        tracks.append({"sub_path": path, "language": language if LANGUAGE_RE.fullmatch(language) else None, "title": title or None})
+    return tracks, default
+
+def variant_names(fname, tracks):
+    # "Episode 01 [English]", "Episode 01 [Signs]", ... one output name per track
+    names = []
+    for i, track in enumerate(tracks):
+        label = (track["title"] or track["language"] or f"Track {i + 1}").replace("/", "-")
+        name = f"{fname} [{label}]"
+        names.append(f"{fname} [{label} {i + 1}]" if name in names else name)
+    return names
+
+def resolve_font(uid):
+    # Uploaded font, else a saved one, else fonts/default.ttf -> (path, hash, display name)
     font_file = request.files.get('font')
     saved_font_name = request.form.get('saved_font')
+    if request.form.get('font_upload'):
+        tmp = os.path.join(FONT_STORE, f".upload-{uuid.uuid4().hex}")
+        font_name = take_upload(uid, request.form['font_upload'], tmp)
+        if font_name and font_name.lower().endswith(FONT_EXTENSIONS):
+            font_hash, font_path = add_font(uid, os.path.basename(font_name), tmp)
+            return font_path, font_hash, os.path.basename(font_name)
+        if os.path.exists(tmp): os.remove(tmp)
+    elif font_file and font_file.filename and font_file.filename.lower().endswith(FONT_EXTENSIONS):
+        font_name, font_hash, font_path = save_font_upload(uid, font_file)
+        return font_path, font_hash, font_name
+    if saved_font_name:
+        font_hash, font_path = user_font(uid, saved_font_name)
+        if font_path: return font_path, font_hash, saved_font_name
 
-    if font_file and font_file.filename:
-        final_font_path = os.path.join(FONT_FOLDER, f"{uid}_{font_file.filename}")
-        font_file.save(final_font_path)
-    elif saved_font_name:
-        final_font_path = os.path.join(FONT_FOLDER, f"{uid}_{saved_font_name}")
-    
     # --- DEFAULT FONT LOGIC ---
-    if not final_font_path:
-        default_font = os.path.join(FONT_FOLDER, "default.ttf")
-        if os.path.exists(default_font):
-            final_font_path = default_font
+    default_font = os.path.join(FONT_FOLDER, "default.ttf")
+    if os.path.exists(default_font):
+        return default_font, file_digest(default_font), None
+    return None, None, None
 
-    font_arg = ['-attach', final_font_path, '-metadata:s:t', 'mimetype=application/x-truetype-font'] if final_font_path else []
+def submit_job(uid, fname, spec, probe=None, **fields):
+    # Without a probe result the job waits for the preparer before a worker may claim it
+    realname = f"{uid}_{fname}.mkv"
+    output_path = os.path.join(DOWNLOAD_FOLDER, realname)
+    if probe: fields.update(prepared=1, duration=probe["duration"], expected_size=estimate_output_size(probe), spool_size=estimate_spool_size(probe))
+    else: fields.update(prepared=0)
+    outputs = spec.get("outputs") or [realname]
+    # The cache holds single outputs; one MKV per track always runs
+    key = None if spec.get("outputs") else result_cache_key(spec, fields.get("live", 0))
+    cached = key and cache_lookup(key)
+    if cached:
+        link_or_copy(cached, output_path)
+        remove_staged_inputs(spec)
+        job_create(uid, realname, fname, spec, **dict(fields, state="done", percent=100, prepared=1, size=os.path.getsize(output_path),
+                                                        finished_at=time.time(), cache_key=key))
+        metric_add("muxer_jobs_submitted_total", 'result="cached"')
+        return "cached"
 
-    output_path = os.path.join(DOWNLOAD_FOLDER, f"{uid}_{fname}.mkv")
-    open(output_path, 'w').close()
+    # Start from a new inode: the old output may be a hardlink into the cache
+    for name in outputs:
+        path = os.path.join(DOWNLOAD_FOLDER, name)
+        try: os.remove(path)
+        except OSError: pass
+        open(path, 'w').close()
+    job_create(uid, realname, fname, spec, cache_key=key, **fields)
+    for name in outputs[1:]:
+        job_create(uid, name, name[len(uid) + 1:-len(".mkv")], {}, **dict(fields, prepared=1, parent=realname, spool_size=None))
+    metric_add("muxer_jobs_submitted_total", 'result="queued"')
+    notify_scheduler()
+    return "queued"
 
-    # --- USE SMART FFMPEG PATH ---
-    cmd = [FFMPEG_BIN, '-y', '-headers', f'Referer: {url}', '-tls_verify', '0', '-reconnect', '1', '-reconnect_streamed', '1', '-i', url, '-i', sub_path]
-    cmd.extend(font_arg)
-    cmd.extend(['-map', '0:V', '-map', '0:a', '-map', '1', '-c', 'copy', '-disposition:s:0', 'default', output_path])
+BATCH_NUMBER_RE = re.compile(r"\{n(?::0?(\d+))?\}")
+BATCH_MAX_SUB_BYTES = 20 * 1024 * 1024
+DIGITS_RE = re.compile(r"(\d+)")
 
-    with open(output_path + ".log", "w") as log_file:
-        subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
+def natural_key(name):
+    # "Episode 2" before "Episode 10": digit runs compare as numbers
+    return [int(part) if part.isdigit() else part.lower() for part in DIGITS_RE.split(name)]
+
+def batch_subtitles(uid):
+    # Uploaded subtitle files and the subtitle entries of uploaded zips, in natural filename order, one staging dir each
+    items = []
+    for f in request.files.getlist('subs'):
+        if not f or not f.filename: continue
+        if f.filename.lower().endswith(".zip"):
+            with zipfile.ZipFile(f.stream) as zf:
+                for info in zf.infolist():
+                    if info.is_dir() or not info.filename.lower().endswith(SUB_EXTENSIONS) or info.file_size > BATCH_MAX_SUB_BYTES: continue
+                    items.append((os.path.basename(info.filename), zf.read(info)))
+        elif f.filename.lower().endswith(SUB_EXTENSIONS):
+            items.append((os.path.basename(f.filename), f.read()))
+    staged = []
+    for _, data in sorted(items, key=lambda item: natural_key(item[0])):
+        staging = new_staging_dir()
+        with open(os.path.join(staging, "sub.ass"), 'wb') as out: out.write(data)
+        staged.append(staging)
+    return staged
+
+@app.route('/start_batch', methods=['POST'])
+def start_batch():
+    uid = get_uid()
+    urls = [u.strip() for u in (request.form.get('urls') or '').splitlines() if u.strip()]
+    pattern = (request.form.get('pattern') or '').strip() or "Episode {n:02}"
+    first = (request.form.get('first') or '').strip() or "1"
+    if not first.isdigit():
+        flash("✖ The first episode number must be a whole number.")
+        return redirect(url_for('home'))
+    first = int(first)
+    if not BATCH_NUMBER_RE.search(pattern):
+        flash("✖ The filename pattern needs a {n} placeholder, e.g. 'Show - {n:02}'.")
+        return redirect(url_for('home'))
+    names = [BATCH_NUMBER_RE.sub(lambda m: str(first + i).zfill(int(m.group(1) or 0)), pattern) for i in range(len(urls))]
+    busy = [n for n in names if (j := job_get(f"{uid}_{n}.mkv")) and j["state"] in ACTIVE_STATES]
+    if not urls or busy:
+        flash("✖ Nothing to do: add one URL per line." if not urls else f"✖ Already running: {', '.join(busy)}")
+        return redirect(url_for('home'))
+    try: staged = batch_subtitles(uid)
+    except zipfile.BadZipFile:
+        flash("✖ Could not read the subtitle zip.")
+        return redirect(url_for('home'))
+    ingested = [ingest_subtitle(os.path.join(staging, "sub.ass")) for staging in staged]
+    bad = next((i for i, info in enumerate(ingested) if not info["ok"]), None)
+    if len(staged) != len(urls) or bad is not None:
+        for staging in staged: shutil.rmtree(staging, ignore_errors=True)
+        flash(f"✖ {len(urls)} URLs but {len(staged)} subtitle files." if len(staged) != len(urls) else
+              f"✖ Subtitle for '{names[bad]}' rejected: {ingested[bad]['error']}")
+        return redirect(url_for('home'))
 
-    time.sleep(1)
+    # The font is stored once and shared by every episode
+    font_path, font_hash, font_name = resolve_font(uid)
+    subset = bool(font_subset and request.form.get('subset_font'))
+    batch_id = uuid.uuid4().hex[:10]
+    db().execute("INSERT INTO batches (id, uid, name, created_at) VALUES (?, ?, ?, ?)",
+                 (batch_id, uid, BATCH_NUMBER_RE.sub("*", pattern), time.time()))
+    cached = 0
+    for url, staging, fname, info in zip(urls, staged, names, ingested):
+        spec = {"url": url, "staging": staging, "sub_path": os.path.join(staging, "sub.ass"), "font_path": font_path, "font_hash": font_hash, "font_name": font_name, "subset": subset}
+        picked = referenced_fonts(uid, info["fonts"], {font_hash})
+        if picked: spec["fonts"] = picked
+        if submit_job(uid, fname, spec, batch_id=batch_id) == "cached": cached += 1
+    flash(f"📦 Queued {len(urls)} episodes" + (f" ({cached} ready instantly from cache)." if cached else "."))
     return redirect(url_for('home'))
 
 @app.route('/download/<filename>')
 def download(filename):
+    job = job_get(filename)
+    if not job: abort(404)
     clean = filename.split('_', 1)[1] if '_' in filename else filename
-    return send_from_directory(DOWNLOAD_FOLDER, filename, as_attachment=True, download_name=clean)
+    if job["state"] == "done":
+        job_update(filename, last_downloaded_at=time.time())  # retention evicts least recently downloaded first
+        return send_from_directory(DOWNLOAD_FOLDER, filename, as_attachment=True, download_name=clean)
+    if job["live"] and job["state"] in ("queued", "processing"):
+        job_update(filename, last_downloaded_at=time.time())
+        return Response(follow_output(filename), mimetype="video/x-matroska",
+                        headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(clean)}", "Cache-Control": "no-cache"})
+    abort(404)
+
+def follow_output(realname):
+    # Reads the output while ffmpeg is still writing it: at EOF wait for more data until the job ends
+    path = os.path.join(DOWNLOAD_FOLDER, realname)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(LIVE_CHUNK_SIZE)
+            if data:
+                yield data
+                continue
+            job = job_get(realname)
+            if job is None or job["state"] not in ("queued", "processing"):
+                # Writer is gone: send whatever it flushed last, then stop
+                while data := f.read(LIVE_CHUNK_SIZE):
+                    yield data
+                return
+            time.sleep(LIVE_POLL_INTERVAL)
 
 @app.route('/delete/<filename>')
 def delete(filename):
-    try:
-        os.remove(os.path.join(DOWNLOAD_FOLDER, filename))
-        os.remove(os.path.join(DOWNLOAD_FOLDER, filename + ".log"))
-    except: pass
+    job = job_get(filename)
+    if not job: abort(404)
+    if job["parent"] and job["state"] in ACTIVE_STATES:
+        # Written by another job's ffmpeg: cancelling it cancels every output of that run
+        job = job_get(job["parent"]) or job
+        filename = job["realname"]
+    if job["state"] in ("processing", "cancelling"):
+        # The worker supervising ffmpeg stops it and cleans up
+        job_update(filename, state="cancelling")
+        if SUPERVISOR_SOCKET: notify_scheduler("cancel", realname=filename)
+    else:
+        discard_job(job)
     return redirect(url_for('home'))
 
+# --- RESUMABLE UPLOADS ---
+@app.route('/uploads', methods=['POST'])
+def upload_create():
+    uid = get_uid()
+    data = request.get_json(silent=True) or request.form
+    filename = os.path.basename(str(data.get('filename') or '')).strip()
+    try: size = int(data.get('size'))
+    except (TypeError, ValueError): size = -1
+    if not filename or not 0 < size <= UPLOAD_MAX_BYTES:
+        return jsonify(error=f"Need a filename and a size up to {UPLOAD_MAX_BYTES} bytes"), 400
+    upload_id = uuid.uuid4().hex
+    open(incoming_path(upload_id), 'wb').close()
+    now = time.time()
+    db().execute('INSERT INTO uploads (id, uid, filename, size, "offset", created_at, updated_at) VALUES (?, ?, ?, ?, 0, ?, ?)',
+                 (upload_id, uid, filename, size, now, now))
+    return jsonify(id=upload_id, offset=0), 201, {"Location": url_for('upload_chunk', upload_id=upload_id)}
+
+@app.route('/uploads/<upload_id>', methods=['HEAD', 'PATCH'])
+def upload_chunk(upload_id):
+    row = upload_get(get_uid(), upload_id)
+    if not row: abort(404)
+    headers = {"Upload-Offset": str(row["offset"]), "Upload-Length": str(row["size"]), "Cache-Control": "no-store"}
+    if request.method == 'HEAD': return "", 200, headers
+    try: offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError: return jsonify(error="Upload-Offset header required"), 400, headers
+    if offset != row["offset"]: return jsonify(error="Offset mismatch, resume from Upload-Offset"), 409, headers
+    # Stream the body straight to disk; whatever arrived before a dropped connection is kept
+    written = offset
+    with open(incoming_path(upload_id), 'r+b') as f:
+        f.seek(offset)
+        try:
+            while written < row["size"]:
+                chunk = request.stream.read(min(UPLOAD_CHUNK, row["size"] - written))
+                if not chunk: break
+                f.write(chunk)
+                written += len(chunk)
+        finally:
+            f.truncate(written)
+            db().execute('UPDATE uploads SET "offset" = ?, updated_at = ? WHERE id = ?', (written, time.time(), upload_id))
+    headers["Upload-Offset"] = str(written)
+    return "", 204, headers
+
+@app.route('/probe')
+def probe():
+    url = (request.args.get('url') or '').strip()
+    if not url: return jsonify(ok=False, error="No URL given"), 400
+    return jsonify(probe_source(url))
+
+@app.route('/metrics')
+def metrics():
+    flush_metrics()  # this worker's buffered route timings; others flush on their own schedule
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+# --- ADMIN ---
+ORIGIN_VALUE_RE = re.compile(r"(\d+)([KMG]?)", re.I)
+ORIGIN_VALUE_UNITS = {"": 1, "K": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9}  # SI, as ffmpeg reads them
+
+def admin_digest(purpose):
+    return hmac.new(ADMIN_TOKEN.encode(), purpose.encode(), hashlib.sha256).hexdigest()
+
+def admin_auth():
+    # -> "header", "session" or None. Scripts send X-Admin-Token; browsers post the token once and then carry
+    # a value derived from it in the session (whose signing key is not secret enough to trust a plain flag).
+    # The token never goes into a URL, so it stays out of access logs, history and Referer headers
+    if not ADMIN_TOKEN: abort(404)
+    header = request.headers.get("X-Admin-Token")
+    if header is not None:
+        if not hmac.compare_digest(header.encode(), ADMIN_TOKEN.encode()): abort(403)
+        return "header"
+    return "session" if hmac.compare_digest(session.get("admin", ""), admin_digest("session")) else None
+
+@app.route('/admin/origins', methods=['GET', 'POST'])
+def admin_origins():
+    auth = admin_auth()
+    if request.method == 'POST' and 'token' in request.form:
+        if hmac.compare_digest(request.form['token'].encode(), ADMIN_TOKEN.encode()): session["admin"] = admin_digest("session")
+        else: flash("Wrong admin token.")
+        return redirect(url_for('admin_origins'))
+    if not auth:
+        return render_template(ADMIN_ORIGINS_TEMPLATE, signed_in=False), 403
+    if request.method == 'POST':
+        # Pages signed in through the session post a form value only this deployment's pages know
+        if auth == "session" and not hmac.compare_digest(request.form.get('csrf', ''), admin_digest("form")): abort(403)
+        host = (request.form.get('host') or '').strip()
+        host = origin_host(host) if "://" in host else host.lower()
+        if not host:
+            flash("No host given.")
+            return redirect(url_for('admin_origins'))
+        pinned = {}
+        for name in ORIGIN_SETTINGS:
+            value = (request.form.get(name) or '').strip()
+            if not value: continue
+            if value.lower() == "default":
+                pinned[name] = None
+                continue
+            m = ORIGIN_VALUE_RE.fullmatch(value)
+            if not m:
+                flash(f"{name}: '{value}' is not a number (K/M/G allowed) or 'default'.")
+                return redirect(url_for('admin_origins'))
+            pinned[name] = int(m.group(1)) * ORIGIN_VALUE_UNITS[m.group(2).upper()]
+        pin_origin(host, pinned)
+        flash(f"{host}: " + (", ".join(f"{k}={v}" for k, v in pinned.items()) if pinned else "no pins, learning again"))
+        return redirect(url_for('admin_origins'))
+    profiles = []
+    for row in db().execute("SELECT * FROM origins ORDER BY jobs + probes DESC, host"):
+        learned, settings = origin_settings(row)
+        profiles.append(dict(row, learned=learned, settings=settings, pinned=json.loads(row["pinned"] or "{}")))
+    if request.args.get('format') == 'json': return jsonify(profiles)
+    return render_template(ADMIN_ORIGINS_TEMPLATE, signed_in=True, profiles=profiles, names=ORIGIN_SETTINGS, csrf=admin_digest("form"),
+                           min_samples=ORIGIN_MIN_SAMPLES)
+
+# --- STATUS API ---
+@app.route('/api/jobs')
+def api_jobs():
+    uid = get_uid()
+    etag, last_modified = page_state(uid)
+    if not_modified(etag, last_modified): return conditional(Response(status=304), etag, last_modified)
+    version = user_version(uid)
+    return conditional(jsonify(version=version, jobs=[job_view(j) for j in jobs_for_uid(uid)]), etag, last_modified)
+
+@app.route('/api/jobs/stream')
+def api_jobs_stream():
+    # Server-Sent Events: a full snapshot first, then only the jobs that changed.
+    # The change signal is the page ETag (see page_state): the user's version plus the queue positions
+    # of their queued jobs, which move when other users' jobs are claimed. Idle cost is those lookups per SSE_POLL_INTERVAL.
+    uid = get_uid()
+
+    def events():
+        deadline = time.time() + SSE_MAX_SECONDS
+        version = page_state(uid)[0]
+        sent = {j["realname"]: j for j in map(job_view, jobs_for_uid(uid))}
+        yield "retry: 2000\n"
+        yield f"event: snapshot\ndata: {json.dumps(list(sent.values()))}\n\n"
+        last_beat = time.time()
+        while time.time() < deadline:
+            time.sleep(SSE_POLL_INTERVAL)
+            current = page_state(uid)[0]
+            if current == version:
+                if time.time() - last_beat > 15:
+                    last_beat = time.time()
+                    yield ": keep-alive\n\n"
+                continue
+            version = current
+            jobs = {j["realname"]: j for j in map(job_view, jobs_for_uid(uid))}
+            for realname, job in jobs.items():
+                if sent.get(realname) != job:
+                    yield f"event: job\ndata: {json.dumps(job)}\n\n"
+            for realname in sent.keys() - jobs.keys():
+                yield f"event: remove\ndata: {json.dumps(realname)}\n\n"
+            sent = jobs
+            last_beat = time.time()
+
+    return Response(events(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,190 @@
+"""Local stand-in for a media CDN, used by the benchmarks.
+
+Serves synthetic media rendered once by ffmpeg's lavfi sources (testsrc2 + sine) so a
+benchmark never needs the network. Every URL takes its parameters from the query string:
+
+    /media.mkv?duration=60&bitrate=2000&throttle=500000   single file (mkv, mp4 or ts)
+    /hls/index.m3u8?duration=60&bitrate=2000              HLS playlist + .ts segments
+
+`throttle` caps each connection in bytes/s, like a CDN that limits per-connection speed.
+Range requests are honoured so ranged/segmented fetchers can be measured too.
+
+    python bench/origin.py --port 8090
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+MEDIA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "media")
+CHUNK = 64 * 1024
+CONTENT_TYPES = {".mkv": "video/x-matroska", ".mp4": "video/mp4", ".ts": "video/mp2t", ".m3u8": "application/vnd.apple.mpegurl"}
+
+_render_lock = threading.Lock()
+
+
+def _lavfi_inputs(duration):
+    return ['-f', 'lavfi', '-i', f'testsrc2=size=1280x720:rate=24:duration={duration}',
+            '-f', 'lavfi', '-i', f'sine=frequency=440:sample_rate=48000:duration={duration}']
+
+
+def _video_codec(ffmpeg):
+    encoders = subprocess.run([ffmpeg, '-hide_banner', '-encoders'], capture_output=True, text=True).stdout
+    return ['-c:v', 'libx264', '-preset', 'ultrafast', '-g', '48'] if 'libx264' in encoders else ['-c:v', 'mpeg4', '-g', '48']
+
+
+def render_file(duration, bitrate, ext, ffmpeg="ffmpeg"):
+    # Rendered once per parameter set and reused by later runs
+    path = os.path.join(MEDIA_DIR, f"lavfi_{duration}s_{bitrate}k{ext}")
+    with _render_lock:
+        if not os.path.exists(path):
+            os.makedirs(MEDIA_DIR, exist_ok=True)
+            tmp = path + ".part" + ext
+            cmd = [ffmpeg, '-y', '-v', 'error', *_lavfi_inputs(duration), *_video_codec(ffmpeg),
+                   '-b:v', f'{bitrate}k', '-maxrate', f'{bitrate}k', '-bufsize', f'{bitrate * 2}k', '-c:a', 'aac', '-b:a', '128k']
+            if ext == ".mp4": cmd += ['-movflags', '+faststart']
+            subprocess.run(cmd + [tmp], check=True)
+            os.replace(tmp, path)
+    return path
+
+
+def render_hls(duration, bitrate, ffmpeg="ffmpeg"):
+    folder = os.path.join(MEDIA_DIR, f"hls_{duration}s_{bitrate}k")
+    with _render_lock:
+        if not os.path.exists(os.path.join(folder, "index.m3u8")):
+            tmp = folder + ".part"
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            cmd = [ffmpeg, '-y', '-v', 'error', *_lavfi_inputs(duration), *_video_codec(ffmpeg),
+                   '-b:v', f'{bitrate}k', '-c:a', 'aac', '-b:a', '128k',
+                   '-f', 'hls', '-hls_time', '4', '-hls_playlist_type', 'vod',
+                   '-hls_segment_filename', os.path.join(tmp, 'seg%05d.ts'), os.path.join(tmp, 'index.m3u8')]
+            subprocess.run(cmd, check=True)
+            shutil.rmtree(folder, ignore_errors=True)
+            os.replace(tmp, folder)
+    return folder
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        if self.server.verbose: super().log_message(*args)
+
+    def _params(self):
+        parts = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        opts = self.server.defaults
+        return parts.path, {
+            "duration": int(query.get("duration", opts["duration"])),
+            "bitrate": int(query.get("bitrate", opts["bitrate"])),
+            "throttle": int(query.get("throttle", opts["throttle"])),
+        }
+
+    def _resolve(self):
+        path, p = self._params()
+        if self.server.media_file:
+            return self.server.media_file, p
+        if path.startswith("/media."):
+            ext = os.path.splitext(path)[1]
+            if ext not in (".mkv", ".mp4", ".ts"): return None, p
+            return render_file(p["duration"], p["bitrate"], ext, self.server.ffmpeg), p
+        if path.startswith("/hls/"):
+            folder = render_hls(p["duration"], p["bitrate"], self.server.ffmpeg)
+            name = os.path.basename(path)
+            full = os.path.join(folder, name)
+            return (full if re.fullmatch(r"[\w.-]+", name) and os.path.exists(full) else None), p
+        return None, p
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _serve(self, body):
+        try: path, p = self._resolve()
+        except subprocess.CalledProcessError:
+            self.send_error(500, "ffmpeg could not render the test media")
+            return
+        if not path:
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        m = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if m and (m.group(1) or m.group(2)):
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            else:
+                start = max(size - int(m.group(2)), 0)
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES.get(os.path.splitext(path)[1], "application/octet-stream"))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not body: return
+        throttle = p["throttle"]
+        sent, began = 0, time.monotonic()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK, remaining))
+                if not chunk: break
+                try: self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError): return
+                remaining -= len(chunk)
+                sent += len(chunk)
+                if throttle:
+                    ahead = sent / throttle - (time.monotonic() - began)
+                    if ahead > 0: time.sleep(ahead)
+
+
+def serve(host="127.0.0.1", port=0, duration=30, bitrate=2000, throttle=0, media_file=None, ffmpeg="ffmpeg", verbose=False):
+    """Starts the origin on a background thread and returns the server (see .server_address)."""
+    server = ThreadingHTTPServer((host, port), OriginHandler)
+    server.daemon_threads = True
+    server.defaults = {"duration": duration, "bitrate": bitrate, "throttle": throttle}
+    server.media_file = media_file
+    server.ffmpeg = ffmpeg
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--duration", type=int, default=30, help="default media length in seconds")
+    parser.add_argument("--bitrate", type=int, default=2000, help="default video bitrate in kbit/s")
+    parser.add_argument("--throttle", type=int, default=0, help="default per-connection cap in bytes/s (0 = none)")
+    parser.add_argument("--media-file", help="serve this file for every /media.* URL instead of rendering one")
+    parser.add_argument("--ffmpeg", default=shutil.which("ffmpeg") or "ffmpeg")
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args.duration, args.bitrate, args.throttle, args.media_file, args.ffmpeg, verbose=True)
+    print(f"origin listening on http://{args.host}:{server.server_address[1]}/media.mkv")
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
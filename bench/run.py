@@ -0,0 +1,286 @@
+"""Benchmarks for the muxer, runnable offline on one Linux box.
+
+Scenarios:
+    mux   N concurrent jobs against the local origin (bench/origin.py): queue wait,
+          time-to-first-byte through a live download, total mux time, aggregate MB/s
+    home  latency of / and /api/jobs with 10, 1k and 10k outputs + logs pre-seeded in
+          downloads/, including the one-time registry import on first start
+
+Each run starts app.py in a throwaway working directory and writes one JSON file to
+bench/results/ (git commit, parameters, numbers) so runs can be compared across commits.
+
+    python bench/run.py all
+    python bench/run.py mux --jobs 8 --duration 120 --bitrate 4000 --throttle 2000000
+    python bench/run.py home --sizes 10 1000 10000
+"""
+import argparse
+import base64
+import http.cookiejar
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+import zlib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+import origin  # noqa: E402
+
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+SAMPLE_ASS = """[Script Info]
+ScriptType: v4.00+
+PlayResX: 1280
+PlayResY: 720
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,48,&H00FFFFFF,&H000000FF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,2,0,2,10,10,10,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+""" + "".join(f"Dialogue: 0,0:00:{i:02d}.00,0:00:{i:02d}.90,Default,,0,0,0,,Benchmark line {i}\n" for i in range(60))
+SAMPLE_LOG = """ffmpeg version bench
+Input #0, matroska,webm, from 'http://origin/media.mkv':
+  Duration: 00:23:40.00, start: 0.000000, bitrate: 2133 kb/s
+Output #0, matroska, to 'out.mkv':
+frame=34080 fps=0.0 q=-1.0 Lsize=  370000kB time=00:23:40.00 bitrate=2133.0kbits/s speed= 120x
+video:340000kB audio:22000kB subtitle:10kB other streams:0kB global headers:0kB muxing overhead: 0.101%
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    try: return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip() or None
+    except OSError: return None
+
+
+def percentile(values, q):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def summary(values):
+    return {"n": len(values), "min": min(values, default=None), "p50": percentile(values, 0.5),
+            "p95": percentile(values, 0.95), "max": max(values, default=None),
+            "mean": statistics.fmean(values) if values else None}
+
+
+class AppServer:
+    """app.py in a subprocess, in its own working directory, on a free port."""
+
+    def __init__(self, workdir, env=None):
+        self.workdir = workdir
+        self.port = free_port()
+        self.base = f"http://127.0.0.1:{self.port}"
+        self.env = dict(os.environ, **(env or {}))
+        self.proc = None
+        self.startup_seconds = None
+
+    def start(self):
+        code = ("import os, sys; os.chdir(sys.argv[1]); sys.path.insert(0, sys.argv[2]); import app; "
+                "app.app.run(host='127.0.0.1', port=int(sys.argv[3]), threaded=True)")
+        began = time.monotonic()
+        self.proc = subprocess.Popen([sys.executable, "-c", code, self.workdir, REPO_DIR, str(self.port)],
+                                     env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while time.monotonic() - began < 600:
+            if self.proc.poll() is not None: raise RuntimeError("app.py exited during startup")
+            try:
+                urllib.request.urlopen(self.base + "/api/jobs", timeout=2).read()
+                self.startup_seconds = time.monotonic() - began
+                return self
+            except OSError: time.sleep(0.1)
+        raise RuntimeError("app.py did not come up")
+
+    def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try: self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired: self.proc.kill()
+
+
+class Client:
+    """One browser: its own cookie jar, so its own uid."""
+
+    def __init__(self, base):
+        self.base = base
+        self.jar = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.jar), NoRedirect)
+
+    def get(self, path, timeout=60):
+        with self.opener.open(self.base + path, timeout=timeout) as r: return r.read()
+
+    def post_multipart(self, path, fields, files):
+        boundary = uuid.uuid4().hex
+        body = bytearray()
+        for name, value in fields.items():
+            body += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, (filename, data) in files.items():
+            body += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'.encode()
+            body += b'Content-Type: application/octet-stream\r\n\r\n' + data + b'\r\n'
+        body += f'--{boundary}--\r\n'.encode()
+        req = urllib.request.Request(self.base + path, data=bytes(body), method="POST",
+                                     headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        with self.opener.open(req, timeout=120) as r: return r.status
+
+    def uid(self):
+        # Flask keeps the uid in a signed (not encrypted) cookie: read the payload
+        for cookie in self.jar:
+            if cookie.name != "session": continue
+            payload = cookie.value
+            compressed = payload.startswith(".")
+            data = payload.lstrip(".").split(".")[0]
+            raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+            return json.loads(zlib.decompress(raw) if compressed else raw)["uid"]
+        return None
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs): return None
+
+    def http_error_302(self, req, fp, code, msg, headers): return fp
+
+
+def run_mux(args):
+    """N clients submit at once; each follows its job with a live download."""
+    workdir = tempfile.mkdtemp(prefix="muxbench-")
+    org = origin.serve(duration=args.duration, bitrate=args.bitrate, throttle=args.throttle,
+                       media_file=args.media_file, ffmpeg=args.ffmpeg)
+    source = f"http://127.0.0.1:{org.server_address[1]}/media.mkv?duration={args.duration}&bitrate={args.bitrate}&throttle={args.throttle}"
+    if not args.media_file: origin.render_file(args.duration, args.bitrate, ".mkv", args.ffmpeg)  # render outside the timing
+    app = AppServer(workdir, {"MAX_CONCURRENT_JOBS": str(args.concurrency or args.jobs), "MAX_JOBS_PER_UID": "1",
+                              "CACHE_MAX_BYTES": "0"}).start()
+    results = []
+    barrier = threading.Barrier(args.jobs)
+
+    def one(i):
+        client = Client(app.base)
+        client.get("/")
+        name = f"bench{i:03d}-{uuid.uuid4().hex[:6]}"
+        barrier.wait()
+        began = time.monotonic()
+        client.post_multipart("/start", {"url": source, "fname": name, "live": "on"}, {"sub": ("bench.ass", SAMPLE_ASS.encode())})
+        submitted = time.monotonic()
+        first_byte, total_bytes = None, 0
+        realname = f"{client.uid()}_{name}.mkv"
+        req = client.opener.open(f"{app.base}/download/{urllib.request.quote(realname)}", timeout=3600)
+        while chunk := req.read(256 * 1024):
+            if first_byte is None: first_byte = time.monotonic()
+            total_bytes += len(chunk)
+        finished = time.monotonic()
+        state = next((j for j in json.loads(client.get("/api/jobs"))["jobs"] if j["realname"] == realname), {})
+        results.append({"job": i, "submit_seconds": submitted - began,
+                        "ttfb_seconds": first_byte - began if first_byte else None,
+                        "total_seconds": finished - began, "bytes": total_bytes, "state": state.get("status")})
+
+    threads = [threading.Thread(target=one, args=(i,)) for i in range(args.jobs)]
+    wall_began = time.monotonic()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall = time.monotonic() - wall_began
+    app.stop()
+    org.shutdown()
+    if not args.keep: shutil.rmtree(workdir, ignore_errors=True)
+    total_bytes = sum(r["bytes"] for r in results)
+    return {
+        "params": {"jobs": args.jobs, "concurrency": args.concurrency or args.jobs, "duration": args.duration,
+                   "bitrate_kbps": args.bitrate, "throttle_bps": args.throttle},
+        "wall_seconds": wall,
+        "aggregate_mb_per_s": total_bytes / wall / 1e6 if wall else None,
+        "ttfb_seconds": summary([r["ttfb_seconds"] for r in results if r["ttfb_seconds"] is not None]),
+        "total_seconds": summary([r["total_seconds"] for r in results]),
+        "failed": sum(r["state"] != "done" for r in results),
+        "jobs": results,
+    }
+
+
+def seed_outputs(workdir, uid, count, own):
+    # `own` outputs belong to the measured user, the rest to other users
+    downloads = os.path.join(workdir, "downloads")
+    os.makedirs(downloads, exist_ok=True)
+    for i in range(count):
+        owner = uid if i < own else uuid.uuid4().hex[:8]
+        path = os.path.join(downloads, f"{owner}_Episode {i:05d}.mkv")
+        with open(path, "wb") as f: f.write(b"\x1a\x45\xdf\xa3" + b"\0" * 1020)
+        with open(path + ".log", "w") as f: f.write(SAMPLE_LOG)
+
+
+def run_home(args):
+    out = []
+    for size in args.sizes:
+        workdir = tempfile.mkdtemp(prefix="homebench-")
+        # First start only hands out a uid; the registry is rebuilt from the seeded files on the second
+        app = AppServer(workdir).start()
+        client = Client(app.base)
+        client.get("/")
+        uid = client.uid()
+        app.stop()
+        for name in os.listdir(workdir):
+            if name.startswith("muxer.db"): os.remove(os.path.join(workdir, name))
+        own = min(size, args.own)
+        seed_outputs(workdir, uid, size, own)
+        app = AppServer(workdir).start()
+        client.base = app.base  # same cookie, new port
+        timings = {}
+        for path in ("/", "/api/jobs"):
+            client.get(path)  # warm-up
+            samples = []
+            for _ in range(args.requests):
+                began = time.monotonic()
+                client.get(path)
+                samples.append(time.monotonic() - began)
+            timings[path] = summary(samples)
+        app.stop()
+        if not args.keep: shutil.rmtree(workdir, ignore_errors=True)
+        out.append({"outputs": size, "own_outputs": own, "startup_seconds": app.startup_seconds, "latency_seconds": timings})
+    return {"params": {"sizes": args.sizes, "requests": args.requests}, "runs": out}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Muxer benchmarks (offline)")
+    parser.add_argument("scenario", choices=["mux", "home", "all"])
+    parser.add_argument("--jobs", type=int, default=4, help="mux: concurrent submissions")
+    parser.add_argument("--concurrency", type=int, default=0, help="mux: MAX_CONCURRENT_JOBS for the app (default: --jobs)")
+    parser.add_argument("--duration", type=int, default=60, help="mux: source length in seconds")
+    parser.add_argument("--bitrate", type=int, default=2000, help="mux: source video bitrate in kbit/s")
+    parser.add_argument("--throttle", type=int, default=0, help="mux: per-connection origin cap in bytes/s")
+    parser.add_argument("--media-file", help="mux: serve this file instead of rendering lavfi media")
+    parser.add_argument("--ffmpeg", default=shutil.which("ffmpeg") or "ffmpeg")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000], help="home: seeded output counts")
+    parser.add_argument("--own", type=int, default=50, help="home: how many seeded outputs the measured user owns")
+    parser.add_argument("--requests", type=int, default=50, help="home: timed requests per page")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directories")
+    parser.add_argument("--output", help="result file (default: bench/results/<time>-<commit>.json)")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    report = {"commit": commit, "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+              "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()}}
+    if args.scenario in ("mux", "all"): report["mux"] = run_mux(args)
+    if args.scenario in ("home", "all"): report["home"] = run_home(args)
+
+    path = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{(commit or 'nogit')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f: json.dump(report, f, indent=2)
+    print(json.dumps({k: v for k, v in report.items() if k != "mux"} | (
+        {"mux": {k: v for k, v in report["mux"].items() if k != "jobs"}} if "mux" in report else {}), indent=2))
+    print(f"results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+"""gunicorn settings, read by `gunicorn app:application` when started from this directory.
+
+Every open page keeps an /api/jobs/stream request for up to SSE_MAX_SECONDS, so sync workers (one request
+at a time) would stall every other request while a single tab is open. Threaded workers give each stream
+its own thread; size GUNICORN_THREADS for the number of pages expected to be open at once per worker.
+"""
+import os
+
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 64))
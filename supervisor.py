@@ -0,0 +1,264 @@
+"""Runs every ffmpeg job outside the web workers.
+
+    SUPERVISOR_SOCKET=/run/muxer/supervisor.sock python supervisor.py
+    SUPERVISOR_SOCKET=/run/muxer/supervisor.sock gunicorn app:application
+
+Start it from the web app's working directory (it shares muxer.db, downloads/ and uploads/). Web workers
+started with the same SUPERVISOR_SOCKET run no scheduler threads: they queue jobs in the registry and
+nudge the supervisor over the socket (one JSON object per line: wake, cancel, status). The supervisor
+claims queued jobs itself, so nothing submitted while it is down is lost.
+
+ffmpeg children run in their own session and outlive a supervisor restart. On start, the supervisor
+adopts the ones still running and sends the other interrupted jobs through the normal retry path
+(resuming from their last progress where possible). Children are started with Popen and watched from the event loop through pidfds rather than with
+asyncio.create_subprocess_exec, whose transports kill still-running children when the loop shuts down.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SOCKET_PATH = os.environ.setdefault("SUPERVISOR_SOCKET", os.path.join(os.getcwd(), "supervisor.sock"))
+
+import app  # noqa: E402  (reads SUPERVISOR_SOCKET, so it starts no scheduler threads of its own)
+from app import (DOWNLOAD_FOLDER, LEASE_SECONDS, MAX_CONCURRENT_JOBS, OWNER_ID, ProgressTail, build_mux_cmd, claim_next_job,  # noqa: E402
+                 complete_job, db, discard_job, finish_job, group_update, job_get, job_stats, job_update, prepare_job_inputs,
+                 reap_orphans)
+
+log = logging.getLogger("supervisor")
+
+
+def watch_exit(proc):
+    # -> (future resolved with the exit code, check() that resolves it if the child is gone)
+    loop = asyncio.get_running_loop()
+    exited = loop.create_future()
+    fd = None
+
+    def check():
+        if exited.done() or proc.poll() is None: return
+        if fd is not None:
+            loop.remove_reader(fd)
+            os.close(fd)
+        exited.set_result(proc.returncode)
+    try:
+        fd = os.pidfd_open(proc.pid)
+        loop.add_reader(fd, check)
+    except (AttributeError, OSError): pass  # no pidfd here: nap() timeouts poll instead
+    return exited, check
+
+
+def ffmpeg_args(pid):
+    # Command line of a live process, or None; guards against pid reuse before adopting or killing it
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f: return f.read().decode("utf-8", "replace").split("\0")
+    except OSError: return None
+
+
+class Supervisor:
+    def __init__(self):
+        self.running = {}  # realname -> monitoring task
+        self.nudges = {}  # realname -> Event set by a 'cancel' request
+        self.wakeup = asyncio.Event()
+        # prepare_job_inputs blocks for a whole prefetch; keep it off the executor that serves registry calls
+        self.preparers = ThreadPoolExecutor(max_workers=max(MAX_CONCURRENT_JOBS, 1), thread_name_prefix="prepare")
+
+    # --- socket API ---
+    async def serve_client(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try: reply = self.handle(json.loads(line))
+                except (ValueError, AttributeError): reply = {"ok": False, "error": "expected one JSON object per line"}
+                writer.write((json.dumps(reply) + "\n").encode())
+                await writer.drain()
+        except ConnectionError: pass
+        finally: writer.close()
+
+    def handle(self, msg):
+        op = msg.get("op")
+        if op == "wake":
+            self.wakeup.set()
+        elif op == "cancel":
+            if msg.get("realname") in self.nudges: self.nudges[msg["realname"]].set()
+        elif op == "status":
+            return {"ok": True, "owner": OWNER_ID, "running": sorted(self.running), "slots": MAX_CONCURRENT_JOBS}
+        else: return {"ok": False, "error": f"unknown op {op!r}"}
+        return {"ok": True}
+
+    # --- scheduling ---
+    async def schedule(self):
+        while True:
+            try:
+                while job := await asyncio.to_thread(claim_next_job):
+                    self.start(job, self.run(job))
+            except Exception: log.exception("claiming a job failed")
+            try: await asyncio.wait_for(self.wakeup.wait(), 2)
+            except asyncio.TimeoutError: pass
+            self.wakeup.clear()
+
+    async def housekeeping(self):
+        while True:
+            try: await asyncio.to_thread(reap_orphans)
+            except Exception: log.exception("housekeeping failed")
+            await asyncio.sleep(30)
+
+    def start(self, job, coro):
+        realname = job["realname"]
+        self.nudges[realname] = asyncio.Event()
+        task = self.running[realname] = asyncio.create_task(coro)
+
+        def done(t):
+            self.running.pop(realname, None)
+            self.nudges.pop(realname, None)
+            if not t.cancelled() and t.exception(): log.error("job %s failed in the supervisor", realname, exc_info=t.exception())
+            self.wakeup.set()  # a slot just freed up
+        task.add_done_callback(done)
+
+    async def run(self, job):
+        realname = job["realname"]
+        output_path = os.path.join(DOWNLOAD_FOLDER, realname)
+        prepared = await asyncio.get_running_loop().run_in_executor(self.preparers, prepare_job_inputs, job)
+        if not prepared: return
+        job, prefetch = prepared
+        feeding = json.loads(job["spec"]).get("input") == "pipe:0"
+        read_fd, write_fd = os.pipe() if feeding else (subprocess.DEVNULL, None)
+        with open(output_path + ".log", "w") as log_file:
+            try: proc = subprocess.Popen(build_mux_cmd(job), stdin=read_fd, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+            except OSError as e:
+                log_file.write(f"Error: could not start ffmpeg: {e}\n")
+                if feeding: os.close(write_fd)
+                if prefetch: prefetch.stop()
+                await asyncio.to_thread(finish_job, job, state="error", error="Could not start ffmpeg")
+                return
+            finally:
+                if feeding: os.close(read_fd)
+        if feeding: threading.Thread(target=prefetch.feed, args=(os.fdopen(write_fd, "wb"),), daemon=True).start()
+        await asyncio.to_thread(job_update, realname, pid=proc.pid)
+        exited, check = watch_exit(proc)
+        tail = ProgressTail(output_path + ".progress", output_path + ".log", duration=job["duration"], opening=True)
+
+        async def wait_exit():
+            await self.nap(realname, exited)
+            check()
+            return exited.result() if exited.done() else None
+
+        async def terminate():
+            for stop, wait in ((proc.terminate, 10), (proc.kill, 5)):
+                stop()
+                for _ in range(wait * 10):
+                    check()
+                    if exited.done(): return
+                    await asyncio.sleep(0.1)
+
+        await self.monitor(job, tail, prefetch, wait_exit, terminate)
+
+    async def adopt(self, job, pid):
+        # An ffmpeg left running by a previous supervisor: not our child, so follow it by pid
+        realname = job["realname"]
+        output_path = os.path.join(DOWNLOAD_FOLDER, realname)
+        tail = ProgressTail(output_path + ".progress", output_path + ".log", duration=job["duration"])
+
+        def alive():
+            args = ffmpeg_args(pid)
+            return bool(args) and output_path in args
+
+        async def wait_exit():
+            await self.nap(realname)
+            if alive(): return None
+            # Exit code is gone with the old supervisor; ffmpeg writes progress=end only after a clean finish
+            tail.poll()
+            return 0 if tail.ended else "Interrupted: ffmpeg stopped while the supervisor was restarting"
+
+        async def terminate():
+            for sig, wait in ((signal.SIGTERM, 10), (signal.SIGKILL, 5)):
+                try: os.kill(pid, sig)
+                except ProcessLookupError: return
+                for _ in range(wait * 10):
+                    if not alive(): return
+                    await asyncio.sleep(0.1)
+
+        await self.monitor(job, tail, None, wait_exit, terminate)
+
+    async def nap(self, realname, *waiting):
+        # Up to 2 s, cut short by the job ending or a cancel request
+        nudge = asyncio.create_task(self.nudges[realname].wait())
+        await asyncio.wait({nudge, *waiting}, timeout=2, return_when=asyncio.FIRST_COMPLETED)
+        nudge.cancel()
+        self.nudges[realname].clear()
+
+    async def monitor(self, job, tail, prefetch, wait_exit, terminate):
+        realname = job["realname"]
+        while True:
+            rc = await wait_exit()
+            current = await asyncio.to_thread(job_get, realname)
+            # Cancelled, or the lease lapsed (a long registry outage) and another node took the job over
+            if current is None or current["state"] == "cancelling" or current["owner"] != OWNER_ID:
+                if prefetch: prefetch.stop()
+                await terminate()
+                if current is None or current["owner"] == OWNER_ID: await asyncio.to_thread(discard_job, job)
+                return
+            tail.poll()
+            if rc is not None: return await asyncio.to_thread(complete_job, job, rc, tail, prefetch)
+            await asyncio.to_thread(group_update, realname, lease_until=time.time() + LEASE_SECONDS, **job_stats(tail, prefetch))
+
+    # --- recovery ---
+    def recover(self):
+        # Jobs claimed on this host by a process that is gone: adopt, requeue or fail them
+        host = socket.gethostname()
+        for job in db().execute("SELECT * FROM jobs WHERE state IN ('processing', 'cancelling') AND owner LIKE ?", (host + ":%",)).fetchall():
+            owner_pid = int(job["owner"].rsplit(":", 1)[1])
+            if owner_pid != os.getpid() and os.path.exists(f"/proc/{owner_pid}"): continue  # its owner is alive
+            output_path = os.path.join(DOWNLOAD_FOLDER, job["realname"])
+            args = ffmpeg_args(job["pid"]) if job["pid"] else None
+            if args and output_path not in args: args = None  # pid reused by something else
+            if args and "pipe:0" not in args and job["state"] == "processing":
+                db().execute("UPDATE jobs SET owner = ?, lease_until = ? WHERE id = ?", (OWNER_ID, time.time() + LEASE_SECONDS, job["id"]))
+                log.info("adopting ffmpeg %s for %s", job["pid"], job["realname"])
+                self.start(job, self.adopt(job, job["pid"]))
+                continue
+            if args:  # fed through a pipe that died with the old supervisor, or being cancelled
+                try: os.kill(job["pid"], signal.SIGKILL)
+                except ProcessLookupError: pass
+            if job["state"] == "cancelling": discard_job(job)
+            else:
+                # Retried (resuming from its last progress where possible) or failed, like any other failed attempt
+                log.info("recovering interrupted job %s", job["realname"])
+                tail = ProgressTail(output_path + ".progress", output_path + ".log", duration=job["duration"]).poll()
+                complete_job(job, "Interrupted: the supervisor running it stopped", tail)
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    if os.path.exists(SOCKET_PATH):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s: s.connect(SOCKET_PATH)
+            sys.exit(f"another supervisor is listening on {SOCKET_PATH}")
+        except ConnectionRefusedError: os.remove(SOCKET_PATH)  # left behind by one that died
+
+    supervisor = Supervisor()
+    supervisor.recover()
+    server = await asyncio.start_unix_server(supervisor.serve_client, path=SOCKET_PATH)
+    threading.Thread(target=app._preparer_loop, daemon=True).start()  # batch probes and the storage sweep
+    tasks = [asyncio.create_task(supervisor.schedule()), asyncio.create_task(supervisor.housekeeping())]
+    log.info("supervising up to %d ffmpeg jobs on %s as %s", MAX_CONCURRENT_JOBS, SOCKET_PATH, OWNER_ID)
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+    await stop.wait()
+    # ffmpeg keeps running in its own session; the next supervisor adopts it
+    log.info("stopping, %d ffmpeg jobs left running for the next start", len(supervisor.running))
+    server.close()
+    for task in [*tasks, *supervisor.running.values()]: task.cancel()
+    app.flush_metrics()
+    try: os.remove(SOCKET_PATH)
+    except OSError: pass
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
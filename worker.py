@@ -0,0 +1,41 @@
+"""Runs muxing jobs on this machine for web nodes that only accept uploads and serve downloads.
+
+    STORAGE_ROOT=/mnt/muxer DB_JOURNAL_MODE=DELETE MUXER_ROLE=web gunicorn app:application
+    STORAGE_ROOT=/mnt/muxer DB_JOURNAL_MODE=DELETE MAX_CONCURRENT_JOBS=8 WORKER_SLOTS=4 python worker.py
+
+Every node mounts the same storage root at the same path (job specs hold absolute paths) and shares the
+registry in it; SQLite's WAL mode needs shared memory, so a registry on NFS/SMB has to use DELETE. A worker
+claims a queued job with a lease of LEASE_SECONDS that each progress update renews. When a node dies, the
+next reaper on any node takes over the lapsed lease and retries the job, resuming from its last progress
+where it can. MAX_CONCURRENT_JOBS still caps ffmpeg processes across all nodes, WORKER_SLOTS per worker.
+
+To try it on one host, start several of these in the same directory as the web app. SIGTERM or Ctrl-C stops
+claiming and exits once the running jobs have finished.
+"""
+import logging
+import signal
+import sys
+import threading
+
+import app
+
+log = logging.getLogger("worker")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    if app.SUPERVISOR_SOCKET or app.MUXER_ROLE == "web":
+        sys.exit("worker.py runs jobs itself: unset SUPERVISOR_SOCKET and MUXER_ROLE=web for it")
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM): signal.signal(sig, lambda *_: stop.set())
+    app.ensure_scheduler()
+    log.info("running up to %d jobs as %s on %s (%s journal, %ds leases)",
+             app.WORKER_SLOTS, app.OWNER_ID, app.STORAGE_ROOT, app.DB_JOURNAL_MODE, app.LEASE_SECONDS)
+    while not stop.wait(1): pass
+    log.info("stopping: no new claims, waiting for running jobs")
+    for thread in app.stop_scheduler(): thread.join()
+    app.flush_metrics()
+
+
+if __name__ == "__main__":
+    main()